@@ -0,0 +1,371 @@
+import asyncio
+import json
+import ssl
+from http.client import parse_headers
+from io import BytesIO
+from os import getenv
+from threading import Lock
+from time import time
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from download_docs import Page, documents_query, raise_graphql_errors
+from transport import DecodingReader, RateLimiter
+
+
+class _BufferedResponse(BytesIO):
+    """A response body that has already been read, for DecodingReader."""
+
+    def __init__(self, body, headers):
+        super().__init__(body)
+        self.headers = headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class AsyncClient:
+    """Client to handle the underlying HTTP calls to the Polecat API in asyncio.
+
+    The asyncio counterpart of download_docs.Client. Queries are sent over a
+    bounded pool of persistent HTTP/1.1 connections opened with asyncio
+    streams, so a single thread can have hundreds of queries in progress at
+    once. Configuration and behaviour otherwise match Client.
+
+    Keyword Arguments:
+        - token -- API token for authentication.
+            If excluded will check POLECAT_API_TOKEN environment variable.
+        - url -- The URL to execute API calls against.
+            It is unlikely that the default needs to be overridden.
+            Default ``https://api.polecat.com/graphql``
+        - timeout -- The timeout for HTTP calls to the API.
+            Default 60
+        - page_size -- The number of results to include for paginated queries.
+            Default 100
+        - max_retry_wait -- The maximum time in seconds to wait between retries.
+            Default 30
+        - max_retries -- The maximum number of successive retries.
+            Default 3
+        - pool_size -- The maximum number of connections open to the API
+            at once. Further queries wait for a connection to be free.
+            Default 100
+        - compress -- Ask the API to compress responses with gzip or
+            deflate.
+            Default True
+        - rate_limiter -- A transport.RateLimiter to pace requests with.
+            It can be shared with blocking clients. A limiter with a
+            lock_file is called from a thread so that it can't block the
+            event loop.
+        - hooks -- Functions to report each request to, called with the
+            same events as the hooks of Client.
+            Default no hooks
+
+    Attributes:
+        - bytes_received -- The number of response body bytes received
+            from the API, before decompression.
+        - bytes_decoded -- The number of response body bytes after
+            decompression.
+
+    Methods (all coroutines):
+        - execute_query(query, variables) -- Execute a generic Graphql query
+            against the Polecat API.
+        - execute_query_with_retries(query, variables) -- Execute a query,
+            retrying when rate limited.
+        - close() -- Close any open connections to the API.
+
+    Proxies are not supported.
+    """
+
+    _max_retries_msg = "Maximum number of retries exceeded"
+
+    def __init__(
+            self, token="", url="https://api.polecat.com/graphql",
+            timeout=60, page_size=100, max_retry_wait=30, max_retries=3,
+            pool_size=100, compress=True, rate_limiter=None, hooks=()):
+        if token == "":
+            token = getenv("POLECAT_API_TOKEN", "")
+        parts = urlsplit(url)
+        self.token = token
+        self.url = url
+        self.timeout = timeout
+        self.page_size = page_size
+        self.max_retry_wait = max_retry_wait
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.compress = compress
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+        self.hooks = list(hooks)
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self._bytes_lock = Lock()
+        self._host = parts.hostname
+        self._ssl = parts.scheme == "https"
+        self._port = parts.port or (443 if self._ssl else 80)
+        self._path = parts.path or "/"
+        if parts.query:
+            self._path += "?" + parts.query
+        self._idle = []
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close any open connections to the API."""
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def _headers(self, length):
+        """Return the raw headers for a Polecat API request."""
+        headers = {
+            "Host": self._host,
+            "Authorization": "api-key " + self.token,
+            "Content-Type": "application/json",
+            "Content-Length": str(length),
+            "Connection": "keep-alive",
+        }
+        if self.compress:
+            headers["Accept-Encoding"] = "gzip, deflate"
+        lines = ["POST " + self._path + " HTTP/1.1"]
+        lines += [name + ": " + value for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def _count_bytes(self, received, decoded):
+        """Add to the totals of bytes received and decoded."""
+        with self._bytes_lock:
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+
+    def _call_hooks(self, event, details):
+        for hook in self.hooks:
+            hook(event, details)
+
+    async def _connect(self):
+        if self._ssl:
+            connection = asyncio.open_connection(
+                self._host, self._port, ssl=ssl.create_default_context())
+        else:
+            connection = asyncio.open_connection(self._host, self._port)
+        return await asyncio.wait_for(connection, self.timeout)
+
+    async def _call_limiter(self, method, *args):
+        """Call a method of the rate limiter.
+
+        A limiter sharing a lock file waits for the file lock and reads and
+        writes the file, so it is called in a thread to keep that from
+        blocking every other query on the event loop.
+        """
+        if self.rate_limiter.lock_file is None:
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, method, *args)
+
+    async def _read_body(self, reader, headers):
+        """Read a response body, returning it and whether it ended the
+        connection."""
+        if headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b""):
+                        pass
+                    return b"".join(chunks), False
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        if headers.get("Content-Length") is not None:
+            return await reader.readexactly(int(headers["Content-Length"])), False
+        return await reader.read(), True
+
+    async def _exchange(self, conn, request):
+        """Send a request on a connection and read the response.
+
+        Returns the status, reason, headers and body of the response and
+        whether the connection can be reused.
+        """
+        reader, writer = conn
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the API")
+        version, status, reason = (
+            status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line)
+        headers = parse_headers(BytesIO(b"".join(header_lines) + b"\r\n"))
+        body, closed = await self._read_body(reader, headers)
+        reusable = not closed and version != "HTTP/1.0" and (
+            headers.get("Connection", "").lower() != "close")
+        return int(status), reason, headers, body, reusable
+
+    async def _request(self, data):
+        """POST data to the API, reusing a pooled connection if possible.
+
+        A pooled connection that the API has closed is replaced with a new
+        one and the request sent again.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+        request = self._headers(len(data)) + data
+        async with self._slots:
+            reused = bool(self._idle)
+            conn = self._idle.pop() if reused else await self._connect()
+            reusable = False
+            try:
+                while True:
+                    try:
+                        response = await asyncio.wait_for(
+                            self._exchange(conn, request), self.timeout)
+                        break
+                    except (ConnectionError, asyncio.IncompleteReadError):
+                        if not reused:
+                            raise
+                        conn[1].close()
+                        conn, reused = await self._connect(), False
+                reusable = response[4]
+            finally:
+                if reusable:
+                    self._idle.append(conn)
+                else:
+                    conn[1].close()
+        return response[:4]
+
+    async def execute_query(self, query, variables={}):
+        """Execute a generic Graphql query against the Polecat API.
+
+        Keyword Arguments:
+            - query -- A string containing a graphql query.
+            - variables -- A dictionary containing variables for the query.
+                Default {}
+
+        Returns the body of the API response.
+
+        No HTTP exceptions are handled, to handle rate limiting (HTTP Code 429)
+        use execute_query_with_retries().
+        """
+        data = json.dumps(
+            {"query": query, "variables": variables}
+            ).encode('UTF-8')
+        wait = await self._call_limiter(self.rate_limiter.reserve)
+        await asyncio.sleep(wait)
+        start = time()
+        status, reason, headers, body = await self._request(data)
+        await self._call_limiter(self.rate_limiter.record, status, headers)
+        if status >= 400:
+            raise HTTPError(self.url, status, reason, headers, BytesIO(body))
+        reader = DecodingReader(
+            _BufferedResponse(body, headers), self._count_bytes)
+        body = reader.read()
+        received = time()
+        result = json.loads(body)
+        self._call_hooks("response", {
+            "latency": received - start,
+            "bytes_received": reader.bytes_received,
+            "bytes_decoded": len(body),
+            "decode_time": time() - received,
+            "wait": wait,
+        })
+        return result
+
+    async def execute_query_with_retries(self, query, variables={}):
+        """Execute a generic Graphql query against the Polecat API with retries.
+
+        Keyword Arguments:
+            - query -- A string containing a graphql query.
+            - variables -- A dictionary containing variables for the query.
+                Default {}
+
+        Returns the body of the API response.
+
+        Will handle a 429 HTTP response by retrying the request but will throw
+        an exception if the retries exceed either the max_retries configured
+        for the class instance.
+        No other HTTP exceptions are handled.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.execute_query(query, variables)
+            except HTTPError as err:
+                if err.code != 429:
+                    raise
+                print("Rate limit exceeded, retrying with backoff")
+                wait = int(err.headers.get("Retry-After"))
+                wait = min(wait, self.max_retry_wait)
+                self._call_hooks(
+                    "retry", {"status": err.code, "retry_after": wait})
+                if attempt == self.max_retries:
+                    raise HTTPError(
+                        err.url, err.code, self._max_retries_msg,
+                        err.hdrs, err.fp) from err
+                await self._call_limiter(self.rate_limiter.pause, wait)
+
+
+async def aget_documents(
+        client, insight, label="", after=None, page_count=1, tables=None,
+        focus_filter=None):
+    """Get all documents matching an insight with an AsyncClient.
+
+    The asynchronous version of download_docs.get_documents, for use with
+    async for.
+
+    Keyword Arguments:
+        - client -- An instance of the AsyncClient class to execute the query.
+        - insight -- The insight that documents must match.
+        - label -- Text to prefix progress messages with.
+            Default ""
+        - after -- The cursor to continue from, such as the end_cursor of a
+            page from an earlier call. If excluded starts from the beginning.
+        - page_count -- The number given to the first page returned.
+            Default 1
+        - tables -- The output tables the documents will be written to, only
+            the fields they need are requested.
+            If excluded requests the fields of every table.
+        - focus_filter -- The type of the ids argument of the companies of
+            documents, from download_docs.focus_filter_type(). If given only
+            the focus company of each document is requested.
+
+    Returns a Page (a list of documents) for each page of results.
+
+    Can result in the same exceptions as the execute_query AsyncClient method.
+    An exception will also be raised if the Graphql response contains an error.
+    """
+    query = documents_query(tables, focus_filter)
+    variables = {
+        "insight": insight,
+        "first": client.page_size
+    }
+    if "$companyIds" in query:
+        # A single id is accepted for a list of ids too.
+        variables["companyIds"] = insight["focusId"]
+    if after is not None:
+        variables["after"] = after
+    next_page = True
+    while next_page:
+        print(label + "PAGE " + str(page_count) + ":")
+        response = await client.execute_query_with_retries(query, variables)
+        raise_graphql_errors(response)
+        data = response.get("data")
+        if data is None:
+            break
+        next_page = data["documents"]["pageInfo"]["hasNextPage"]
+        variables["after"] = data["documents"]["pageInfo"]["endCursor"]
+        yield Page(
+            [edge["node"] for edge in data["documents"]["edges"]],
+            page_count, variables["after"], next_page)
+        page_count += 1
@@ -0,0 +1,513 @@
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+from os import devnull
+from tempfile import TemporaryDirectory
+from textwrap import dedent
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory isn't reported.
+    resource = None
+
+from download_docs import (
+    Client, Page, get_documents, get_documents_sharded, make_insight,
+    prefetch, write_docs)
+from mock_server import MockAPI, MockServer
+from sinks import CSVSink, write_all_headers
+
+
+def _sequential(client, insight, sink):
+    for page in get_documents(client, insight):
+        write_docs(page, insight["focusId"], sink)
+        yield len(page)
+
+
+def _prefetch(client, insight, sink):
+    for page in prefetch(get_documents(client, insight), 2):
+        write_docs(page, insight["focusId"], sink)
+        yield len(page)
+
+
+def _stream(client, insight, sink):
+    for page in get_documents(client, insight, stream=True):
+        write_docs(page, insight["focusId"], sink)
+        yield len(page)
+
+
+def _sharded(client, insight, sink):
+    for page in get_documents_sharded(client, insight, "day", 4):
+        write_docs(page, insight["focusId"], sink)
+        yield len(page)
+
+
+# Each scenario downloads the insight and writes it to a sink, yielding the
+# number of documents in each page.
+SCENARIOS = {
+    "sequential": _sequential,
+    "prefetch": _prefetch,
+    "stream": _stream,
+    "sharded": _sharded,
+}
+
+
+def _write_docs_per_row(documents, focus_id, sink):
+    """The write_docs from before rows were built in a single pass and
+    written a table at a time, kept to compare against."""
+    for doc in documents:
+
+        doc_base = [
+            doc["id"],
+            doc["harvestTime"],
+            doc["sentiment"],
+            doc["reach"],
+        ]
+
+        sink.writerow(
+            "documents",
+            doc_base
+            + [
+                doc["publisher"],
+                doc["domain"],
+                doc["source"],
+                doc["url"],
+                doc["title"],
+            ]
+        )
+
+        for company in doc["companies"]:
+            if company["company"]["id"] == focus_id:
+                for topic in doc["topics"]:
+                    sink.writerow(
+                        "denormalised",
+                        doc_base[:2]
+                        + [doc["source"]]
+                        + doc_base[2:]
+                        + [
+                            company["company"]["id"],
+                            company["company"]["name"],
+                            company["significance"],
+                            topic["topic"]["id"],
+                            topic["topic"]["name"],
+                            topic["significance"],
+                        ]
+                    )
+
+        for company in doc["companies"]:
+            if company["company"]["id"] == focus_id:
+                sink.writerow(
+                    "companies",
+                    (
+                        doc["id"],
+                        company["company"]["id"],
+                        company["company"]["name"],
+                        company["significance"],
+                    )
+                )
+
+        for topic in doc["topics"]:
+            sink.writerow(
+                "topics",
+                (
+                    doc["id"],
+                    topic["topic"]["id"],
+                    topic["topic"]["name"],
+                    topic["significance"],
+                )
+            )
+
+    sink.end_page()
+
+
+# The implementations of write_docs compared by the --write-docs benchmark.
+WRITERS = {
+    "per-row": _write_docs_per_row,
+    "fused": write_docs,
+}
+
+
+class _NullSink:
+    """A sink that counts the rows written to it and discards them."""
+
+    def __init__(self):
+        self.rows = 0
+
+    def writerow(self, table, row):
+        self.rows += 1
+
+    def writerows(self, table, rows):
+        self.rows += len(rows)
+
+    def end_page(self):
+        pass
+
+
+def synthetic_page(documents=1000, companies=20, topics=50):
+    """Return a page of documents for the focus company "focus".
+
+    Each document mentions the focus and companies - 1 other companies and
+    has topics topics, so every document has topics denormalised rows.
+    """
+    page = []
+    for number in range(documents):
+        document_id = "d{:07d}".format(number)
+        page.append({
+            "id": document_id,
+            "harvestTime": "2022-01-01T00:00:00Z",
+            "title": "Document " + document_id,
+            "domain": "example.com",
+            "url": "https://example.com/" + document_id,
+            "source": "NEWS",
+            "publisher": "Publisher",
+            "reach": number,
+            "sentiment": "NEUTRAL",
+            "companies": [
+                {
+                    "company": {
+                        "id": "focus" if company == 0 else "c" + str(company),
+                        "name": "Company " + str(company),
+                    },
+                    "significance": 0.5,
+                }
+                for company in range(companies)],
+            "topics": [
+                {
+                    "topic": {
+                        "id": "t" + str(topic),
+                        "name": "Topic " + str(topic),
+                    },
+                    "significance": 0.5,
+                }
+                for topic in range(topics)],
+        })
+    return Page(page, 1, None, False)
+
+
+def run_write_benchmark(writer, sink_name, page, pages):
+    """Write a page of documents pages times with a write_docs
+    implementation, to a sink discarding the rows ("null") or to CSVs in a
+    temporary directory ("csv").
+
+    Returns a dictionary of measurements.
+    """
+    with TemporaryDirectory() as directory:
+        if sink_name == "csv":
+            write_all_headers([], directory)
+            sink = CSVSink(directory=directory)
+        else:
+            sink = _NullSink()
+        # Count the rows of the page once, outside the timing.
+        counter = _NullSink()
+        WRITERS[writer](page, "focus", counter)
+        start = perf_counter()
+        for _ in range(pages):
+            WRITERS[writer](page, "focus", sink)
+        if sink_name == "csv":
+            sink.close()
+        elapsed = perf_counter() - start
+    rows = counter.rows * pages
+    return {
+        "writer": writer,
+        "sink": sink_name,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_sec": rows / elapsed,
+    }
+
+
+def output_write_results(results):
+    baselines = {
+        result["sink"]: result["rows_per_sec"] for result in results
+        if result["writer"] == "per-row"}
+    print("{:<10} {:<6} {:>10} {:>12} {:>8}".format(
+        "WRITER", "SINK", "ROWS", "ROWS/SEC", "SPEEDUP"))
+    for result in results:
+        print("{:<10} {:<6} {:>10} {:>12.0f} {:>7.2f}x".format(
+            result["writer"], result["sink"], result["rows"],
+            result["rows_per_sec"],
+            result["rows_per_sec"] / baselines[result["sink"]]))
+
+
+def percentile(values, fraction):
+    """Return the value a fraction of the way through the sorted values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss():
+    """Return the peak memory used by this process in bytes, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def run_scenario(name, url, days, page_size, compress):
+    """Download days of documents from url with a scenario.
+
+    The documents are written to CSVs in a temporary directory which is
+    deleted afterwards, and progress messages are discarded.
+
+    Returns a dictionary of measurements.
+    """
+    insight = make_insight(
+        "focus", "taxonomy", str(date(2022, 1, 1)),
+        str(date(2022, 1, 1) + timedelta(days=days - 1)))
+    latencies = []
+
+    def record_latency(event, details):
+        if event == "response":
+            latencies.append(details["latency"])
+
+    client = Client(
+        url=url, page_size=page_size, compress=compress, max_retry_wait=5,
+        max_retries=10, hooks=[record_latency])
+    documents = 0
+    with TemporaryDirectory() as directory, open(devnull, "w") as quiet:
+        write_all_headers([], directory)
+        start = perf_counter()
+        with redirect_stdout(quiet), client, CSVSink(
+                directory=directory) as sink:
+            for count in SCENARIOS[name](client, insight, sink):
+                documents += count
+        elapsed = perf_counter() - start
+    return {
+        "scenario": name,
+        "documents": documents,
+        "seconds": elapsed,
+        "docs_per_sec": documents / elapsed,
+        "mb_per_sec": client.bytes_received / elapsed / 1e6,
+        "decoded_mb_per_sec": client.bytes_decoded / elapsed / 1e6,
+        "requests": len(latencies),
+        "p50_latency": percentile(latencies, 0.5),
+        "p99_latency": percentile(latencies, 0.99),
+        "peak_rss": peak_rss(),
+    }
+
+
+def _milliseconds(seconds):
+    return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+
+
+def output_results(results):
+    print("{:<12} {:>9} {:>10} {:>8} {:>11} {:>8} {:>8} {:>12}".format(
+        "SCENARIO", "DOCS", "DOCS/SEC", "MB/SEC", "JSON MB/SEC", "P50 MS",
+        "P99 MS", "PEAK RSS MB"))
+    for result in results:
+        rss = "-" if result["peak_rss"] is None else "{:.1f}".format(
+            result["peak_rss"] / 1e6)
+        print("{:<12} {:>9} {:>10.0f} {:>8.2f} {:>11.2f} {:>8} {:>8} {:>12}"
+              .format(
+                  result["scenario"], result["documents"],
+                  result["docs_per_sec"], result["mb_per_sec"],
+                  result["decoded_mb_per_sec"],
+                  _milliseconds(result["p50_latency"]),
+                  _milliseconds(result["p99_latency"]), rss))
+
+
+def main():
+
+    parser = ArgumentParser(
+        prog="Benchmark",
+        description="""Measure download performance against a local mock API.\n
+        Starts mock_server.py and downloads documents from it to CSVs in a
+        temporary directory with each scenario in turn, reporting documents
+        and megabytes per second, request latency and peak memory use.
+        Each scenario runs in its own process so peak memory is measured
+        separately.
+
+        With --write-docs nothing is downloaded, instead write_docs is
+        timed turning a synthetic page of documents with many topics into
+        rows, against the per-row implementation it replaced.
+        """,
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--scenario",
+                        help=dedent("""\
+                        OPTIONAL. A scenario to run, one of: {}.
+                        Repeat the flag to run several.
+                        Default all of them
+
+                        """.format(", ".join(SCENARIOS))),
+                        choices=tuple(SCENARIOS),
+                        action="append",
+                        default=[])
+    parser.add_argument("--days",
+                        help=dedent("""\
+                        OPTIONAL. The number of days of documents to
+                        download.
+                        Default 30
+
+                        """),
+                        type=int,
+                        default=30)
+    parser.add_argument("--documents-per-day",
+                        help=dedent("""\
+                        OPTIONAL. The number of documents on each day.
+                        Default 200
+
+                        """),
+                        type=int,
+                        default=200)
+    parser.add_argument("--document-size",
+                        help=dedent("""\
+                        OPTIONAL. The approximate size of each document
+                        in bytes.
+                        Default 1000
+
+                        """),
+                        type=int,
+                        default=1000)
+    parser.add_argument("--page-size",
+                        help=dedent("""\
+                        OPTIONAL. The number of documents to request
+                        at a time.
+                        Default 100
+
+                        """),
+                        type=int,
+                        default=100)
+    parser.add_argument("--latency",
+                        help=dedent("""\
+                        OPTIONAL. Seconds the mock API waits before every
+                        response.
+                        Default 0.05
+
+                        """),
+                        type=float,
+                        default=0.05)
+    parser.add_argument("--rate-limit",
+                        help=dedent("""\
+                        OPTIONAL. The chance, from 0 to 1, of the mock API
+                        answering a request with a 429 response.
+                        Default 0
+
+                        """),
+                        type=float,
+                        default=0)
+    parser.add_argument("--no-compress",
+                        help=dedent("""\
+                        OPTIONAL. Don't ask for compressed responses.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--json",
+                        help=dedent("""\
+                        OPTIONAL. Print the results of each scenario as a
+                        line of JSON instead of a table.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--write-docs",
+                        help=dedent("""\
+                        OPTIONAL. Measure the rows per second write_docs
+                        builds from a synthetic page of --page-size
+                        documents instead of downloading.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--topics-per-document",
+                        help=dedent("""\
+                        OPTIONAL. The number of topics of each document in
+                        the --write-docs page.
+                        Default 50
+
+                        """),
+                        type=int,
+                        default=50)
+    parser.add_argument("--companies-per-document",
+                        help=dedent("""\
+                        OPTIONAL. The number of companies, including the
+                        focus company, of each document in the --write-docs
+                        page.
+                        Default 20
+
+                        """),
+                        type=int,
+                        default=20)
+    parser.add_argument("--pages",
+                        help=dedent("""\
+                        OPTIONAL. The number of times the --write-docs page
+                        is written.
+                        Default 20
+
+                        """),
+                        type=int,
+                        default=20)
+    parser.add_argument("--url",
+                        help=dedent("""\
+                        OPTIONAL. The URL of an API to benchmark against
+                        instead of starting the mock API.
+
+                        """),
+                        type=str)
+    # Used to run a single scenario in a child process.
+    parser.add_argument("--child", action="store_true", help=dedent("""\
+                        INTERNAL. Run one --scenario against --url and print
+                        its results as JSON.
+
+                        """))
+    args = parser.parse_args()
+    compress = not args.no_compress
+
+    if args.write_docs:
+        page = synthetic_page(
+            args.page_size, args.companies_per_document,
+            args.topics_per_document)
+        results = [
+            run_write_benchmark(writer, sink, page, args.pages)
+            for sink in ("null", "csv") for writer in WRITERS]
+        if args.json:
+            for result in results:
+                print(json.dumps(result))
+        else:
+            output_write_results(results)
+        return
+
+    if args.child:
+        print(json.dumps(run_scenario(
+            args.scenario[0], args.url, args.days, args.page_size, compress)))
+        return
+
+    server = None
+    url = args.url
+    if url is None:
+        api = MockAPI(
+            args.documents_per_day, args.document_size,
+            latency=args.latency, rate_limit=args.rate_limit, retry_after=1,
+            seed=0)
+        server = MockServer(api).start()
+        url = server.url
+    try:
+        results = []
+        for name in args.scenario or SCENARIOS:
+            command = [
+                sys.executable, __file__, "--child", "--scenario", name,
+                "--url", url, "--days", str(args.days),
+                "--page-size", str(args.page_size)]
+            if args.no_compress:
+                command.append("--no-compress")
+            output = subprocess.run(
+                command, check=True, stdout=subprocess.PIPE,
+                universal_newlines=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            if args.json:
+                print(json.dumps(result), flush=True)
+        if not args.json:
+            output_results(results)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import csv
+import mmap
+import re
+from hashlib import blake2b
+from math import log
+from pathlib import Path
+
+from sinks import open_csv
+
+
+class BloomFilter:
+    """A set of strings held in a small amount of memory.
+
+    Strings can be added and tested for but not listed or removed. Testing
+    for a string that was never added wrongly finds it, with a probability
+    of around error_rate, but a string that was added is always found.
+
+    Memory is allocated for capacity strings. Once more than that have been
+    added another filter twice the size, with half the error rate, is added
+    for the strings that follow, so the error rate stays around error_rate
+    however many strings are added.
+
+    Keyword Arguments:
+        - capacity -- The number of strings expected to be added.
+        - error_rate -- The chance of a string wrongly being found.
+            Default 0.001
+
+    Attributes:
+        - count -- The number of strings added.
+
+    Supports add(value) and the in operator like a set.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity < 1:
+            raise ValueError("A BloomFilter needs a capacity of at least 1")
+        self.count = 0
+        # Each filter is (capacity, size in bits, number of hashes, bits).
+        self._filters = []
+        # The error rates of the filters, halving each time, add up to less
+        # than twice that of the first.
+        self._add_filter(capacity, error_rate / 2)
+
+    def _add_filter(self, capacity, error_rate):
+        # Small filters are given more bits than the formula needs, since
+        # a few bits are soon all set.
+        size = max(1024, int(-capacity * log(error_rate) / log(2) ** 2))
+        hashes = max(1, round(-log(error_rate) / log(2)))
+        self._filters.append(
+            (capacity, size, hashes, bytearray((size + 7) // 8)))
+        self._error_rate = error_rate
+        self._filled = 0
+
+    def _hashes(self, value):
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return first, step
+
+    def add(self, value):
+        capacity = self._filters[-1][0]
+        if self._filled >= capacity:
+            print("BLOOM FILTER FULL AFTER " + str(self.count)
+                  + " IDS, ADDING ROOM FOR " + str(capacity * 2))
+            self._add_filter(capacity * 2, self._error_rate / 2)
+        _, size, hashes, bits = self._filters[-1]
+        first, step = self._hashes(value)
+        for i in range(hashes):
+            position = (first + i * step) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self._filled += 1
+        self.count += 1
+
+    def __contains__(self, value):
+        first, step = self._hashes(value)
+        return any(
+            all(bits[position >> 3] & (1 << (position & 7))
+                for position in (
+                    (first + i * step) % size for i in range(hashes)))
+            for _, size, hashes, bits in self._filters)
+
+
+# The id at the start of a row of documents.csv, after the header, followed
+# by the start of the harvest time so that lines inside multi-line titles
+# never match.
+_DOCUMENT_ID = re.compile(rb'\n"([^"]+)","\d{4}-')
+
+
+def read_document_ids(file, seen, compression=None):
+    """Add the ids of the documents already in a documents CSV to a set.
+
+    An uncompressed CSV is memory mapped and the ids are found with a
+    regular expression rather than parsing every row, so even very large
+    files are read quickly.
+
+    Keyword Arguments:
+        - file -- The path of the documents CSV.
+        - seen -- The set, or BloomFilter, to add the ids to.
+        - compression -- The compression of the CSV, "gzip", "zstd" or None.
+            Default None
+
+    Returns nothing.
+    """
+    if compression is not None:
+        with open_csv(file, compression) as fin:
+            reader = csv.reader(fin)
+            next(reader, None)
+            for row in reader:
+                seen.add(row[0])
+        return
+    if Path(file).stat().st_size == 0:
+        return
+    with open(file, "rb") as fin, mmap.mmap(
+            fin.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for document_id in _DOCUMENT_ID.findall(data):
+            seen.add(document_id.decode())
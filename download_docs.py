@@ -1,17 +1,34 @@
-import csv
 import json
-from os import getenv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from functools import partial
+from datetime import date, timedelta
+from itertools import islice
+from os import fsync, getenv, replace
 from pathlib import Path
-from time import sleep
+from queue import Queue, Full
+from socket import timeout as socket_timeout
+from threading import Event, Lock, Thread, local
+from time import time
 from urllib.error import HTTPError
-from urllib.request import urlopen, Request
-from argparse import ArgumentParser, RawTextHelpFormatter
+from argparse import ArgumentParser, ArgumentTypeError, RawTextHelpFormatter
 from textwrap import dedent
 
+from dedup import BloomFilter, read_document_ids
+from metrics import PageMetrics
+from sinks import (
+    ArrowSink, COMPRESSED_EXTENSIONS, CSVSink, CSV_FILES, DIMENSION_FILES,
+    SQLITE_FILE, SQLiteSink, check_appendable, csv_name, existing_csvs,
+    output_files, parse_harvest_time, write_all_headers)
+from transport import (
+    ConnectionPool, DecodingReader, RateLimiter, StreamedResponse)
+
+
 class Client:
     """Client to handle the underlying HTTP calls to the Polecat API.
 
-    A simple class that uses urllib.request to send queries to the 
+    A simple class that uses http.client to send queries to the 
     Polecat API. Generic configuration that applies to different API
     calls is stored in the class so that only the graphql query and
     variables need to be supplied for query execution.
@@ -37,10 +54,44 @@ class Client:
             be retried. The request won't be retried if it has already been
             tried this many times.
             Default 3
+        - pool_size -- The maximum number of persistent connections kept
+            open to the API. Connections are reused between requests and
+            can be shared by multiple threads using the same client.
+            Default 4
+        - compress -- Ask the API to compress responses with gzip or
+            deflate. Responses are decompressed as they are read.
+            Default True
+        - rate_limiter -- A RateLimiter to pace requests with. Share one
+            limiter between clients to keep their combined requests under
+            the rate limit. If excluded requests are not paced but all
+            requests from the client are paused after a 429 response.
+        - hooks -- Functions to report each request to, such as to record
+            metrics. Each is called with the name of an event and a
+            dictionary describing it, in the thread making the request:
+            "response" once a response has been read, with the details in
+            last_response, and "retry" when a 429 response is received,
+            with its status and the retry_after wait in seconds.
+            Default no hooks
+
+    Attributes:
+        - bytes_received -- The number of response body bytes received
+            from the API, before decompression.
+        - bytes_decoded -- The number of response body bytes after
+            decompression.
+        - last_response -- A dictionary describing the last response
+            received in the current thread: its latency in seconds until
+            the body was read (until the headers arrived when streamed),
+            bytes_received, bytes_decoded, decode_time in seconds to parse
+            the JSON (None when streamed) and wait, the seconds slept
+            before sending the request to keep to the rate limit.
+        - hooks -- The list of hook functions, which can be added to.
 
     Methods:
         - execute_query(query, variables) -- Execute a generic Graphql query
             against the Polecat API.
+        - stream_query_with_retries(query, variables, key) -- Execute a
+            Graphql query, decoding the array named key as it is read.
+        - close() -- Close any open connections to the API.
     """
 
     
@@ -48,7 +99,8 @@ class Client:
 
     def __init__(
             self, token="", url="https://api.polecat.com/graphql", 
-            timeout=60, page_size=100, max_retry_wait=30, max_retries=3):
+            timeout=60, page_size=100, max_retry_wait=30, max_retries=3,
+            pool_size=4, compress=True, rate_limiter=None, hooks=()):
         if token == "":
             token = getenv("POLECAT_API_TOKEN", "")
         self.token = token
@@ -57,13 +109,54 @@ class Client:
         self.page_size = page_size
         self.max_retry_wait = max_retry_wait
         self.max_retries = max_retries
-        
+        self.compress = compress
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self._bytes_lock = Lock()
+        self._pool = ConnectionPool(url, size=pool_size, timeout=timeout)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+        self.hooks = list(hooks)
+        self._local = local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close any open connections to the API."""
+        self._pool.close()
+
+    @property
+    def last_response(self):
+        return getattr(self._local, "last_response", None)
+
     def _headers(self):
         """Return headers needed for a Polecat API request"""
-        return {
+        headers = {
             "Authorization": "api-key " + self.token,
             "Content-Type": "application/json"
         }
+        if self.compress:
+            headers["Accept-Encoding"] = "gzip, deflate"
+        return headers
+
+    def _count_bytes(self, received, decoded):
+        """Add to the totals of bytes received and decoded."""
+        with self._bytes_lock:
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+
+    def _call_hooks(self, event, details):
+        for hook in self.hooks:
+            hook(event, details)
+
+    def _record_response(self, details):
+        self._local.last_response = details
+        self._call_hooks("response", details)
 
     def execute_query(self, query, variables={}):
         """Execute a generic Graphql query against the Polecat API.
@@ -81,12 +174,36 @@ class Client:
         data = json.dumps(
             {"query": query, "variables": variables}
             ).encode('UTF-8')
-        request = Request(url=self.url, data=data, headers=self._headers())
-        with urlopen(url=request, timeout=self.timeout) as response:
-            body = response.read()
+        wait = self.rate_limiter.acquire()
+        start = time()
+        with self._pool.request(data, self._headers()) as response:
+            self.rate_limiter.record(response.status, response.headers)
+            reader = DecodingReader(response, self._count_bytes)
+            body = reader.read()
+        received = time()
         result = json.loads(body)
+        self._record_response({
+            "latency": received - start,
+            "bytes_received": reader.bytes_received,
+            "bytes_decoded": len(body),
+            "decode_time": time() - received,
+            "wait": wait,
+        })
         return result
 
+    def _back_off_after(self, err, attempt):
+        """Back off after a 429 response, raising if out of retries."""
+        print("Rate limit exceeded, retrying with backoff") 
+        wait = int(err.headers.get("Retry-After"))
+        wait = min(wait, self.max_retry_wait)
+        self.rate_limiter.record(err.code, err.headers)
+        self._call_hooks("retry", {"status": err.code, "retry_after": wait})
+        if attempt == self.max_retries:
+            raise HTTPError(
+                err.url, err.code, self._max_retries_msg, 
+                err.hdrs, err.fp) from err
+        self.rate_limiter.pause(wait)
+
     def execute_query_with_retries(self, query, variables={}):
         """Execute a generic Graphql query against the Polecat API with retries.
         
@@ -100,6 +217,8 @@ class Client:
         Will handle a 429 HTTP response by retrying the request but will throw
         an exception if the retries exceed either the max_retries configured
         for the class instance.
+        The wait requested by a 429 response applies to every request using
+        the same rate limiter, so concurrent requests back off together.
         No other HTTP exceptions are handled.
         """
         for attempt in range(self.max_retries + 1):
@@ -108,17 +227,344 @@ class Client:
             except HTTPError as err:
                 if err.code != 429:
                     raise
-                print("Rate limit exceeded, retrying with backoff") 
-                wait = int(err.headers.get("Retry-After"))
-                wait = min(wait, self.max_retry_wait)
-                if attempt == self.max_retries:
-                    raise HTTPError(
-                        err.url, err.code, self._max_retries_msg, 
-                        err.hdrs, err.fp) from err
-                sleep(wait)
+                self._back_off_after(err, attempt)
+
+    @contextmanager
+    def stream_query_with_retries(self, query, variables={}, key="edges"):
+        """Execute a Graphql query, decoding a large array as it is read.
+
+        Keyword Arguments:
+            - query -- A string containing a graphql query.
+            - variables -- A dictionary containing variables for the query.
+                Default {}
+            - key -- The name of the array in the response to stream.
+                Default "edges"
+
+        A context manager returning a StreamedResponse. The response must be
+        iterated within the with block as it is read from the open
+        connection.
+
+        Rate limiting is handled in the same way as
+        execute_query_with_retries().
+        """
+        data = json.dumps(
+            {"query": query, "variables": variables}
+            ).encode('UTF-8')
+        decoded = [0]
+
+        def count_bytes(received, decoded_bytes):
+            decoded[0] += decoded_bytes
+            self._count_bytes(received, decoded_bytes)
+
+        for attempt in range(self.max_retries + 1):
+            wait = self.rate_limiter.acquire()
+            start = time()
+            with ExitStack() as stack:
+                try:
+                    response = stack.enter_context(
+                        self._pool.request(data, self._headers()))
+                except HTTPError as err:
+                    if err.code != 429:
+                        raise
+                    self._back_off_after(err, attempt)
+                    continue
+                latency = time() - start
+                self.rate_limiter.record(response.status, response.headers)
+                reader = DecodingReader(response, count_bytes)
+                yield StreamedResponse(reader, key)
+            self._record_response({
+                "latency": latency,
+                "bytes_received": reader.bytes_received,
+                "bytes_decoded": decoded[0],
+                "decode_time": None,
+                "wait": wait,
+            })
+            return
+
+
+class Page(list):
+    """A page of documents along with its position in the result set.
+
+    Behaves exactly like the list of documents it holds.
+
+    Attributes:
+        - number -- The number of the page, starting from 1.
+        - end_cursor -- The cursor to request the following page with.
+        - has_next_page -- Whether there are more pages after this one.
+    """
+
+    def __init__(self, documents, number, end_cursor, has_next_page):
+        super().__init__(documents)
+        self.number = number
+        self.end_cursor = end_cursor
+        self.has_next_page = has_next_page
+
+
+class StreamedPage:
+    """A page of documents that are decoded as they are iterated over.
+
+    Returned by get_documents when streaming. The documents are read from
+    the open API response, so the page can only be iterated once and must
+    be used before the next page is requested.
+
+    Attributes:
+        - number -- The number of the page, starting from 1.
+        - end_cursor -- The cursor to request the following page with.
+            Only available once the page has been iterated.
+        - has_next_page -- Whether there are more pages after this one.
+            Only available once the page has been iterated.
+
+    len() returns the number of documents iterated so far.
+    """
+
+    def __init__(self, response, number):
+        self._response = response
+        self._count = 0
+        self._documents = self._read_documents()
+        self.number = number
+
+    def __iter__(self):
+        return self._documents
+
+    def _read_documents(self):
+        for edge in self._response:
+            self._count += 1
+            yield edge["node"]
+
+    def __len__(self):
+        return self._count
+
+    def _page_info(self):
+        return self._response.envelope["data"]["documents"]["pageInfo"]
+
+    @property
+    def end_cursor(self):
+        return self._page_info()["endCursor"]
+
+    @property
+    def has_next_page(self):
+        return self._page_info()["hasNextPage"]
+
+
+def raise_graphql_errors(response):
+    """Raise an exception if a Graphql response contains errors."""
+    err = response.get("errors")
+    if err is not None:
+        messages = "\n  ".join([e["message"] for e in err])
+        graphql_err = ("Graphql query returned the following error: \n  " 
+                      + messages + "\nFull error: " + json.dumps(err))
+        raise Exception(graphql_err)
+
+
+# The most documents the API returns in one page.
+MAX_PAGE_SIZE = 1000
+
+
+class PageSizeTuner:
+    """Adjusts the page size of document queries to suit the API.
+
+    Bigger pages need fewer requests but take longer to return and can time
+    out. After each page the size is scaled towards the size that would
+    take target_latency seconds or return target_bytes, whichever is
+    smaller, by at most half or double at a time. A timeout halves the size.
+    Safe to share between threads.
+
+    Keyword Arguments:
+        - initial -- The page size to start with.
+            Default 100
+        - minimum -- The smallest page size to use.
+            Default 10
+        - maximum -- The largest page size to use.
+            Default MAX_PAGE_SIZE
+        - target_latency -- The response time to aim for in seconds.
+            Default 5
+        - target_bytes -- The decoded response size to aim for.
+            Default 10000000
+
+    Attributes:
+        - size -- The page size to request next.
+
+    Methods:
+        - record(latency, bytes_decoded) -- Adjust the size after a response.
+        - timed_out() -- Shrink the size after a request timed out. Returns
+            False if the size was already the minimum.
+    """
+
+    def __init__(
+            self, initial=100, minimum=10, maximum=MAX_PAGE_SIZE,
+            target_latency=5, target_bytes=10000000):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+        self._lock = Lock()
+
+    def _resize(self, size):
+        size = max(self.minimum, min(self.maximum, int(size)))
+        if size != self.size:
+            print("PAGE SIZE " + str(self.size) + " -> " + str(size))
+        self.size = size
+
+    def record(self, latency, bytes_decoded):
+        """Scale the page size towards the targets after a response."""
+        with self._lock:
+            factor = min(
+                self.target_latency / max(latency, 0.001),
+                self.target_bytes / max(bytes_decoded, 1))
+            factor = max(0.5, min(2, factor))
+            self._resize(self.size * factor)
+
+    def timed_out(self):
+        """Halve the page size after a timeout, False if at the minimum."""
+        with self._lock:
+            if self.size <= self.minimum:
+                return False
+            self._resize(self.size / 2)
+            return True
+
+
+# The fields of a document each output table is made from. Sub-fields are
+# given as the selection set to request them with.
+TABLE_FIELDS = {
+    "documents": (
+        "id", "harvestTime", "title", "domain", "url", "source", "publisher",
+        "reach", "sentiment"),
+    "denormalised": (
+        "id", "harvestTime", "source", "reach", "sentiment", "companies",
+        "topics"),
+    "companies": ("id", "companies"),
+    "topics": ("id", "topics"),
+}
+
+
+FIELD_SELECTIONS = {
+    "companies": "companies { company { id name } significance }",
+    "topics": "topics { topic { id name } significance }",
+}
+
+
+# Only the focus company of each document is used, so where the API allows
+# it the other companies are filtered out before they are sent.
+FOCUS_COMPANIES_SELECTION = (
+    "companies(ids: $companyIds) { company { id name } significance }")
+
+
+DOCUMENTS_QUERY_TEMPLATE = """
+    query Documents($insight: InsightQuery!, $first: Int!, $after: Cursor%s) {
+        documents(insight: $insight, first: $first, after: $after, sortAsc: false) {
+            edges {
+                node {
+                    %s
+                }
+            }
+            pageInfo { endCursor hasNextPage }
+        }
+    }
+"""
+
+
+def documents_query(tables=None, focus_filter=None):
+    """Return the documents query selecting only the fields needed to write
+    some of the output tables.
+
+    The id and harvest time of documents are always selected, as they are
+    used to resume, deduplicate and incrementally download documents.
+
+    Keyword Arguments:
+        - tables -- The keys of TABLE_FIELDS to select the fields of.
+            If excluded selects the fields of every table.
+        - focus_filter -- The type of the ids argument of the companies of
+            documents, from focus_filter_type(). If given only the companies
+            whose ids are in the companyIds variable are selected.
+            If excluded every company is selected.
+    """
+    if tables is None:
+        tables = TABLE_FIELDS
+    fields = ["id", "harvestTime"]
+    for table in TABLE_FIELDS:
+        if table in tables:
+            fields += [
+                field for field in TABLE_FIELDS[table] if field not in fields]
+    selections = dict(FIELD_SELECTIONS)
+    variables = ""
+    if focus_filter and "companies" in fields:
+        selections["companies"] = FOCUS_COMPANIES_SELECTION
+        variables = ", $companyIds: " + focus_filter
+    return DOCUMENTS_QUERY_TEMPLATE % (variables, " ".join(
+        selections.get(field, field) for field in fields))
+
+
+DOCUMENTS_QUERY = documents_query()
+
+
+DOCUMENT_FIELDS_QUERY = """
+    query DocumentFields {
+        __type(name: "Document") {
+            fields { name args { name type { ...TypeRef } } }
+        }
+    }
+    fragment TypeRef on __Type {
+        kind name ofType {
+            kind name ofType { kind name ofType { kind name } }
+        }
+    }
+"""
+
+
+def _type_string(type_ref):
+    """Return an introspected type, such as [ID!], or None if it is nested
+    more deeply than was asked for."""
+    if type_ref is None:
+        return None
+    if type_ref["kind"] in ("NON_NULL", "LIST"):
+        inner = _type_string(type_ref.get("ofType"))
+        if inner is None:
+            return None
+        if type_ref["kind"] == "NON_NULL":
+            return inner + "!"
+        return "[" + inner + "]"
+    return type_ref["name"]
+
 
+def focus_filter_type(client):
+    """Return the type of the ids argument that the companies of documents
+    can be filtered by, such as "[ID!]", or None if there isn't one.
 
-def get_documents(client, insight):
+    Looks for the argument with an introspection query. Only an argument
+    taking an ID or String, or a list of them, is used. Returns None if the
+    API doesn't answer the query.
+
+    Keyword Arguments:
+        - client -- An instance of the Client class to execute the query.
+    """
+    try:
+        response = client.execute_query_with_retries(DOCUMENT_FIELDS_QUERY)
+    except HTTPError:
+        return None
+    document = (response.get("data") or {}).get("__type") or {}
+    for field in document.get("fields") or ():
+        if field["name"] != "companies":
+            continue
+        for arg in field["args"]:
+            type_string = _type_string(arg.get("type"))
+            if arg["name"] == "ids" and type_string is not None and (
+                    type_string.strip("[]!") in ("ID", "String")):
+                return type_string
+    return None
+
+
+def selects_companies(tables=None):
+    """Return whether the documents query for some output tables selects
+    the companies of documents, see documents_query()."""
+    if tables is None:
+        tables = TABLE_FIELDS
+    return any("companies" in TABLE_FIELDS[table] for table in tables)
+
+
+def get_documents(
+        client, insight, label="", after=None, page_count=1, stream=False,
+        tuner=None, tables=None, focus_filter=None):
     """Get all documents matching an insight.
 
     Uses the document Graphql query to get all documents matching an insight
@@ -127,195 +573,1039 @@ def get_documents(client, insight):
     Keyword Arguments:
         - client -- An instance of the Client class to execute the query.
         - insight -- The insight that documents must match.
+        - label -- Text to prefix progress messages with.
+            Default ""
+        - after -- The cursor to continue from, such as the end_cursor of a
+            page from an earlier call. If excluded starts from the beginning.
+        - page_count -- The number given to the first page returned.
+            Default 1
+        - stream -- Decode documents one at a time as they are read rather
+            than a page at a time, so memory use does not depend on the
+            page size. Each page must then be used before the next one is
+            requested.
+            Default False
+        - tuner -- A PageSizeTuner to choose the size of each page with.
+            A page that times out is requested again with a smaller size.
+            Cannot be used when streaming. If excluded every page is
+            client.page_size documents.
+        - tables -- The output tables the documents will be written to, only
+            the fields they need are requested. See documents_query().
+            If excluded requests the fields of every table.
+        - focus_filter -- The type of the ids argument of the companies of
+            documents, from focus_filter_type(). If given only the focus
+            company of each document is requested rather than all of its
+            companies.
 
-    Returns a list of documents.
+    Returns a Page (a list of documents) for each page of results, or a
+    StreamedPage when streaming.
 
     Can result in the same exceptions as the execute_query Client method.
     An exception will also be raised if the Graphql response contains an error.
     """
-    query = """
-        query Documents($insight: InsightQuery!, $first: Int!, $after: Cursor) {
-            documents(insight: $insight, first: $first, after: $after, sortAsc: false) {
-                edges {
-                    node {
-                        id harvestTime title domain url 
-                        source publisher reach sentiment
-                        companies { company { id name } significance }
-                        topics { topic { id name } significance }
-                    }
-                }
-                pageInfo { endCursor hasNextPage }
-            }
-        }
-    """
+    query = documents_query(tables, focus_filter)
     variables = {
         "insight": insight,
         "first": client.page_size
     }
+    if "$companyIds" in query:
+        # A single id is accepted for a list of ids too.
+        variables["companyIds"] = insight["focusId"]
+    if after is not None:
+        variables["after"] = after
     next_page = True
-    page_count = 1
     while next_page:
-        print("PAGE " + str(page_count) + ":")
-        response = client.execute_query_with_retries(query, variables)
-        err = response.get("errors")
-        if err is not None:
-            messages = "\n  ".join([e["message"] for e in err])
-            graphql_err = ("Graphql query returned the following error: \n  " 
-                          + messages + "\nFull error: " + json.dumps(err))
-            raise Exception(graphql_err)
+        print(label + "PAGE " + str(page_count) + ":")
+        if stream:
+            with client.stream_query_with_retries(query, variables) as response:
+                page = StreamedPage(response, page_count)
+                yield page
+                for _ in page:
+                    pass
+            raise_graphql_errors(response.envelope)
+            if response.envelope.get("data") is None:
+                break
+            next_page = page.has_next_page
+            variables["after"] = page.end_cursor
+            page_count += 1
+            continue
+        if tuner is None:
+            response = client.execute_query_with_retries(query, variables)
+        else:
+            variables["first"] = tuner.size
+            try:
+                response = client.execute_query_with_retries(query, variables)
+            except socket_timeout:
+                if not tuner.timed_out():
+                    raise
+                continue
+            tuner.record(
+                client.last_response["latency"],
+                client.last_response["bytes_decoded"])
+        raise_graphql_errors(response)
         data = response.get("data") 
         if data is None:
             break
         next_page = data["documents"]["pageInfo"]["hasNextPage"]
         variables["after"] = data["documents"]["pageInfo"]["endCursor"]
+        yield Page(
+            [edge["node"] for edge in data["documents"]["edges"]],
+            page_count, variables["after"], next_page)
         page_count += 1
-        yield [edge["node"] for edge in data["documents"]["edges"]]
-
-def write_headers(file, headers):
-    with open(file, "w") as fout: 
-        writer = csv.writer(fout, dialect="unix", quoting=csv.QUOTE_ALL)
-        writer.writerow(headers)
-
-def write_all_headers(existing):
-    docs_header = (
-        "id",
-        "harvest_time",
-        "sentiment",
-        "reach",
-        "publisher",
-        "domain",
-        "source",
-        "url",
-        "title",
-    )
-
-    denorm_header = (
-        "document_id",
-        "harvest_time",
-        "data_source",
-        "sentiment",
-        "reach",
-        "company_id",
-        "company_name",
-        "company_significance",
-        "topic_id",
-        "topic_name",
-        "topic_significance",
-    )
-
-    comp_header = (
-        "document_id",
-        "company_id",
-        "company_name",
-        "company_significance",
-    )
-
-    tops_header = (
-        "document_id",
-        "topic_id",
-        "topic_name",
-        "topic_significance",
-    )
-
-    file_headers = {
-        "documents.csv": docs_header,
-        "documents_denormalised.csv": denorm_header,
-        "documents_companies.csv": comp_header,
-        "documents_topics.csv": tops_header
-    }
 
-    for k, v in file_headers.items():
-        if k not in existing:
-            write_headers(k, v)
 
-def write_docs(documents, focus_id):
+def split_date_range(from_date, to_date, shards):
+    """Split an inclusive date range into consecutive sub-ranges.
+
+    Keyword Arguments:
+        - from_date -- The first date of the range, formatted yyyy-mm-dd.
+        - to_date -- The last date of the range, formatted yyyy-mm-dd.
+        - shards -- How to split the range. Either "day", "week" or the
+            number of equally sized sub-ranges to create. There are never
+            more sub-ranges than days in the range.
+
+    Returns a list of (from_date, to_date) tuples, newest range first to
+    match the order documents are returned in.
+    """
+    start = date.fromisoformat(from_date)
+    end = date.fromisoformat(to_date)
+    days = (end - start).days + 1
+    if days < 1:
+        return [(from_date, to_date)]
+    if shards == "day":
+        size = 1
+    elif shards == "week":
+        size = 7
+    else:
+        size = None
+        count = max(1, min(int(shards), days))
+    ranges = []
+    if size is not None:
+        for offset in range(0, days, size):
+            ranges.append((offset, min(offset + size, days) - 1))
+    else:
+        for i in range(count):
+            ranges.append((i * days // count, (i + 1) * days // count - 1))
+    return [
+        ((start + timedelta(days=first)).isoformat(),
+         (start + timedelta(days=last)).isoformat())
+        for first, last in reversed(ranges)]
+
+
+def _put_until(results, item, cancelled):
+    """Put item on a bounded queue unless the consumer has gone away."""
+    while not cancelled.is_set():
+        try:
+            results.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _fetch_pages(pages, results, cancelled):
+    """Iterate pages onto the results queue until done or cancelled."""
+    try:
+        for page in pages:
+            if not _put_until(results, ("page", page), cancelled):
+                return
+        _put_until(results, ("done", None), cancelled)
+    except BaseException as err:
+        _put_until(results, ("error", err), cancelled)
+    finally:
+        if hasattr(pages, "close"):
+            pages.close()
+
+
+def prefetch(pages, depth=2):
+    """Fetch pages on a background thread while the caller processes them.
+
+    The pages are read ahead into a bounded queue, so the next page is
+    requested from the API while the current one is being written. When the
+    queue is full the fetcher waits for the caller to catch up, so at most
+    depth pages plus the one being requested are held in memory.
+
+    Keyword Arguments:
+        - pages -- An iterable of pages such as returned by get_documents.
+        - depth -- The maximum number of fetched pages waiting to be used.
+            Default 2
+
+    Returns each page of pages in order.
+
+    Exceptions raised while fetching are raised again by this generator.
+    """
+    results = Queue(maxsize=depth)
+    cancelled = Event()
+    fetcher = Thread(
+        target=_fetch_pages, args=(pages, results, cancelled), daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == "page":
+                yield value
+            elif kind == "done":
+                return
+            else:
+                raise value
+    finally:
+        cancelled.set()
+        fetcher.join()
+
+
+def _fetch_shard(
+        client, insight, adaptive, tuner, tables, focus_filter, results,
+        cancelled):
+    """Fetch every page of one shard onto the results queue.
+
+    When adaptive is set and the shard has more than one page of documents
+    it is split in two instead, the first page is discarded and the halves
+    are handed back to get_documents_sharded to be fetched.
+    """
+    if cancelled.is_set():
+        return
+    label = insight["fromDate"] + ".." + insight["toDate"] + " "
+    try:
+        for page in get_documents(
+                client, insight, label, tuner=tuner, tables=tables,
+                focus_filter=focus_filter):
+            if adaptive and page.number == 1 and page.has_next_page:
+                halves = split_date_range(
+                    insight["fromDate"], insight["toDate"], 2)
+                if len(halves) == 2:
+                    _put_until(results, ("split", halves), cancelled)
+                    return
+            if not _put_until(results, ("page", page), cancelled):
+                return
+        _put_until(results, ("done", None), cancelled)
+    except BaseException as err:
+        _put_until(results, ("error", err), cancelled)
+
+
+def get_documents_sharded(
+        client, insight, shards="week", workers=4, tuner=None, tables=None,
+        focus_filter=None):
+    """Get all documents matching an insight using concurrent requests.
+
+    The date range of the insight is split into shards which are each
+    paged through by a pool of worker threads sharing the client, so rate
+    limit back offs apply to every worker. Pages are yielded in the order
+    they arrive so documents are not in date order across shards.
+
+    Keyword Arguments:
+        - client -- An instance of the Client class to execute the query.
+        - insight -- The insight that documents must match.
+        - shards -- How to split the date range of the insight. Either
+            "day", "week", the number of equally sized shards or "auto".
+            With "auto" the range starts as one shard per worker and any
+            shard with more than one page of documents is halved until each
+            shard is a single day or a single page, which costs one
+            discarded request per split.
+            Default "week"
+        - workers -- The number of shards fetched at the same time.
+            Default 4
+        - tuner -- A PageSizeTuner shared by all shards to choose the size
+            of each page with. If excluded every page is client.page_size
+            documents.
+        - tables -- The output tables the documents will be written to, as
+            for get_documents.
+        - focus_filter -- The type of the ids argument of the companies of
+            documents, as for get_documents.
+
+    Returns a Page (a list of documents) for each page of results.
+
+    Can result in the same exceptions as get_documents.
+    """
+    adaptive = shards == "auto"
+    if adaptive:
+        shards = workers
+    ranges = split_date_range(insight["fromDate"], insight["toDate"], shards)
+    results = Queue(maxsize=workers * 2)
+    cancelled = Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(date_range):
+        shard = dict(insight, fromDate=date_range[0], toDate=date_range[1])
+        executor.submit(
+            _fetch_shard, client, shard, adaptive, tuner, tables,
+            focus_filter, results, cancelled)
+
+    try:
+        for date_range in ranges:
+            submit(date_range)
+        pending = len(ranges)
+        while pending > 0:
+            kind, value = results.get()
+            if kind == "page":
+                yield value
+            elif kind == "split":
+                pending += len(value) - 1
+                for date_range in value:
+                    submit(date_range)
+            elif kind == "done":
+                pending -= 1
+            else:
+                raise value
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=True)
+
+# The number of documents whose rows are built before they are written to
+# a sink, which bounds memory use when pages are streamed.
+WRITE_BATCH_SIZE = 1000
+
+
+def write_docs(documents, focus_id, sink=None):
     """Write a list of documents to CSV files.
     
     The CSV structure chosen has been optimised for analysis based on previous
     experience handling the underlying data. The CSVs will be created in the
     directory the script is called from not the directory containing it.
 
+    The rows of every table are built in a single pass over each document
+    and handed to the sink together, with one writerows call per table for
+    every WRITE_BATCH_SIZE documents.
+
     Keyword Arguments:
         - documents -- A list of documents to include in the CSVs.
         - focus_id -- The id of the company that the documents are linked to.
+        - sink -- A CSVSink, or other sink such as an ArrowSink, to write
+            the rows to. If excluded the CSVs are opened for this call only.
+            When the sink is normalised, company and topic names are left
+            out of the rows and each is written once to the dimension
+            tables instead. Only rows of the sink's tables are written, the
+            documents need only have the fields of those tables.
 
     Returns nothing.
 
     Can result in exceptions related to writing files to disk.
     """
 
-    with open("documents.csv", "a") as docs_fout, open(
-            "documents_denormalised.csv", "a") as denorm_fout, open(
-            "documents_companies.csv", "a") as comp_fout, open(
-            "documents_topics.csv", "a") as tops_fout:
-
-        docs_writer = csv.writer(
-            docs_fout, dialect="unix", quoting=csv.QUOTE_ALL)
+    if sink is None:
+        with CSVSink() as sink:
+            write_docs(documents, focus_id, sink)
+        return
 
-        denorm_writer = csv.writer(
-            denorm_fout, dialect="unix", quoting=csv.QUOTE_ALL)
+    names = getattr(sink, "names", None)
+    tables = output_files(
+        names is not None, getattr(sink, "tables", None) or CSV_FILES)
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, WRITE_BATCH_SIZE))
+        if not batch:
+            break
+        rows = {table: [] for table in tables}
+        if names is None:
+            _build_rows(batch, focus_id, rows)
+        else:
+            _build_normalised_rows(batch, focus_id, rows, names)
+        for table, table_rows in rows.items():
+            if table_rows:
+                sink.writerows(table, table_rows)
+    sink.end_page()
 
-        comp_writer = csv.writer(
-            comp_fout, dialect="unix", quoting=csv.QUOTE_ALL)
 
-        tops_writer = csv.writer(
-            tops_fout, dialect="unix", quoting=csv.QUOTE_ALL)
+def _build_rows(documents, focus_id, rows):
+    """Add the rows of documents to the list of each table in rows."""
+    document_rows = rows.get("documents")
+    denormalised_rows = rows.get("denormalised")
+    company_rows = rows.get("companies")
+    topic_rows = rows.get("topics")
+    need_topics = topic_rows is not None or denormalised_rows is not None
+    need_companies = company_rows is not None or denormalised_rows is not None
 
-        for doc in documents:
+    for doc in documents:
+        doc_id = doc["id"]
 
-            doc_base = [
-                doc["id"],
+        if document_rows is not None:
+            document_rows.append((
+                doc_id,
                 doc["harvestTime"],
                 doc["sentiment"],
                 doc["reach"],
-            ]
+                doc["publisher"],
+                doc["domain"],
+                doc["source"],
+                doc["url"],
+                doc["title"],
+            ))
 
-            docs_writer.writerow(
-                doc_base
-                + [
-                    doc["publisher"],
-                    doc["domain"],
-                    doc["source"],
-                    doc["url"],
-                    doc["title"],
-                ]
+        if need_topics:
+            topics = [
+                (
+                    topic["topic"]["id"],
+                    topic["topic"]["name"],
+                    topic["significance"],
+                )
+                for topic in doc["topics"]]
+            if topic_rows is not None:
+                topic_rows.extend([(doc_id,) + topic for topic in topics])
+
+        if not need_companies:
+            continue
+        # The companies are only filtered to the focus by the API when it
+        # supports it, so they are checked here as well.
+        for company in doc["companies"]:
+            if company["company"]["id"] != focus_id:
+                continue
+            company = (
+                focus_id,
+                company["company"]["name"],
+                company["significance"],
             )
+            if company_rows is not None:
+                company_rows.append((doc_id,) + company)
+            if denormalised_rows is not None:
+                base = (
+                    doc_id,
+                    doc["harvestTime"],
+                    doc["source"],
+                    doc["sentiment"],
+                    doc["reach"],
+                ) + company
+                denormalised_rows.extend([base + topic for topic in topics])
+
 
-            for company in doc["companies"]:
-                if company["company"]["id"] == focus_id:
-                    for topic in doc["topics"]:
-                        denorm_writer.writerow(
-                            doc_base
-                            + [
-                                company["company"]["id"],
-                                company["company"]["name"],
-                                company["significance"],
-                                topic["topic"]["id"],
-                                topic["topic"]["name"],
-                                topic["significance"],
-                            ]
-                        )
-
-            for company in doc["companies"]:
-                if company["company"]["id"] == focus_id:
-                    comp_writer.writerow(
-                        (
-                            doc["id"],
-                            company["company"]["id"],
-                            company["company"]["name"],
-                            company["significance"],
-                        )
-                    )
+def _build_normalised_rows(documents, focus_id, rows, names):
+    """Add the rows of documents to the list of each table in rows, with
+    names in the dimensions."""
+    company_names = names["company_names"]
+    topic_names = names["topic_names"]
+    document_rows = rows.get("documents")
+    denormalised_rows = rows.get("denormalised")
+    company_rows = rows.get("companies")
+    topic_rows = rows.get("topics")
+    company_name_rows = rows.get("company_names")
+    topic_name_rows = rows.get("topic_names")
 
+    for doc in documents:
+        doc_id = doc["id"]
+
+        if document_rows is not None:
+            document_rows.append((
+                doc_id,
+                doc["harvestTime"],
+                doc["sentiment"],
+                doc["reach"],
+                doc["publisher"],
+                doc["domain"],
+                doc["source"],
+                doc["url"],
+                doc["title"],
+            ))
+
+        if topic_name_rows is not None:
+            topics = []
             for topic in doc["topics"]:
-                tops_writer.writerow(
-                    (
-                        doc["id"],
-                        topic["topic"]["id"],
-                        topic["topic"]["name"],
-                        topic["significance"],
-                    )
-                )
+                topic_id = topic["topic"]["id"]
+                if topic_id not in topic_names:
+                    topic_names[topic_id] = topic["topic"]["name"]
+                    topic_name_rows.append((topic_id, topic["topic"]["name"]))
+                topics.append((topic_id, topic["significance"]))
+            if topic_rows is not None:
+                topic_rows.extend([(doc_id,) + topic for topic in topics])
+
+        if company_name_rows is None:
+            continue
+        for company in doc["companies"]:
+            if company["company"]["id"] != focus_id:
+                continue
+            if focus_id not in company_names:
+                company_names[focus_id] = company["company"]["name"]
+                company_name_rows.append(
+                    (focus_id, company["company"]["name"]))
+            company = (focus_id, company["significance"])
+            if company_rows is not None:
+                company_rows.append((doc_id,) + company)
+            if denormalised_rows is not None:
+                base = (
+                    doc_id,
+                    doc["harvestTime"],
+                    doc["source"],
+                    doc["sentiment"],
+                    doc["reach"],
+                ) + company
+                denormalised_rows.extend([base + topic for topic in topics])
+
+
+class PageWriter:
+    """Writes pages of documents to a sink, on a dedicated thread if asked.
+
+    With a high water mark the pages are put on a bounded queue and written
+    in order by a writer thread, so a slow disk only holds up downloading
+    once that many pages are waiting to be written. Otherwise each page is
+    written as soon as it is given.
+
+    An exception raised while writing stops the writer thread and the
+    pages still waiting are discarded. The exception is raised again by
+    the next call to write() or close(), so the download stops rather than
+    carrying on with pages missing from its files. Use it as a context
+    manager, inside the one for the sink, so that the writer thread has
+    stopped before the sink is closed.
+
+    Keyword Arguments:
+        - sink -- The sink to write the pages to with write_docs().
+        - focus_id -- The id of the company that the documents are linked to.
+        - high_water_mark -- The number of pages that can wait to be
+            written before write() waits for the writer thread to catch up.
+            If 0 pages are written by the thread calling write() instead.
+            Default 0
+        - on_written -- A function called after each page is written, from
+            the thread that wrote it, with the page and a dictionary of
+            measurements:
+            - write_time -- Seconds spent writing the page.
+            - queue_depth -- The number of pages waiting to be written when
+                the page was given.
+            - writer_lag -- Seconds from the page being given to it being
+                written.
+
+    Attributes:
+        - depth -- The number of pages waiting to be written.
+        - max_depth -- The most pages that have waited to be written at
+            once.
+
+    Methods:
+        - write(page) -- Write a page, or queue it to be written.
+        - close() -- Wait for the queued pages to be written and stop the
+            writer thread.
+    """
+
+    def __init__(self, sink, focus_id, high_water_mark=0, on_written=None):
+        self.sink = sink
+        self.focus_id = focus_id
+        self.on_written = on_written
+        self.max_depth = 0
+        self._error = None
+        self._stopped = Event()
+        self._queue = None
+        self._thread = None
+        if high_water_mark > 0:
+            self._queue = Queue(maxsize=high_water_mark)
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stop()
+
+    @property
+    def depth(self):
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def _write(self, page, queued, depth):
+        start = time()
+        write_docs(page, self.focus_id, self.sink)
+        finished = time()
+        if self.on_written is not None:
+            self.on_written(page, {
+                "write_time": finished - start,
+                "queue_depth": depth,
+                "writer_lag": finished - queued,
+            })
+
+    def _run(self):
+        """Write the queued pages until stopped or a write fails."""
+        while True:
+            item = self._queue.get()
+            if item is None or self._stopped.is_set():
+                return
+            try:
+                self._write(*item)
+            except BaseException as err:
+                self._error = err
+                self._stopped.set()
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, page):
+        """Write a page, or queue it to be written by the writer thread.
+
+        Waits while high_water_mark pages are already waiting. Raises the
+        exception that stopped the writer thread if a write has failed.
+        """
+        queued = time()
+        if self._queue is None:
+            self._write(page, queued, 0)
+            return
+        self._raise_error()
+        depth = self._queue.qsize()
+        _put_until(self._queue, (page, queued, depth), self._stopped)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        self._raise_error()
+
+    def _stop(self):
+        """Stop the writer thread after the page being written, discarding
+        the pages waiting."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        try:
+            self._queue.put_nowait(None)
+        except Full:
+            # The thread is writing a page and will see it is stopped.
+            pass
+        self._thread.join()
+
+    def close(self):
+        """Wait for the queued pages to be written and stop the writer
+        thread, raising the exception that stopped it if a write failed."""
+        if self._thread is not None:
+            _put_until(self._queue, None, self._stopped)
+            self._thread.join()
+        self._raise_error()
+
+
+def newer_documents(pages, mark):
+    """Filter pages down to documents harvested after a high-water mark.
+
+    Relies on documents being returned newest first. Once a document at or
+    before the mark is reached no more pages are requested.
+
+    Keyword Arguments:
+        - pages -- An iterable of pages such as returned by get_documents.
+        - mark -- The harvestTime of the newest document already downloaded.
+
+    Returns a Page of only the newer documents for each page of results.
+    """
+    mark = parse_harvest_time(mark)
+    for page in pages:
+        newer = [
+            doc for doc in page if parse_harvest_time(doc["harvestTime"]) > mark]
+        yield Page(newer, page.number, page.end_cursor, page.has_next_page)
+        if len(newer) < len(page):
+            return
+
+
+def unique_documents(pages, seen):
+    """Filter pages down to documents whose ids haven't been seen before.
+
+    Removes documents repeated because they were already downloaded by an
+    earlier run, or were returned twice as cursors shifted between pages.
+
+    Keyword Arguments:
+        - pages -- An iterable of pages such as returned by get_documents.
+        - seen -- A set, or BloomFilter, of the ids already written. The
+            id of each document let through is added to it.
+
+    Returns a Page of only the unseen documents for each page of results.
+    """
+    for page in pages:
+        unique = []
+        for doc in page:
+            if doc["id"] not in seen:
+                seen.add(doc["id"])
+                unique.append(doc)
+        yield Page(unique, page.number, page.end_cursor, page.has_next_page)
+
+
+SYNC_STATE_FILE = "sync_state.json"
+
+
+def sync_key(insight):
+    """Return the key identifying an insight in the sync state store.
+
+    The key is made from the focus, taxonomy and filters of the insight but
+    not its dates, so later runs over newer dates share the same key.
+    """
+    return json.dumps([
+        insight["focusId"],
+        insight["taxonomyId"],
+        sorted(insight["languageFilters"]),
+        sorted(insight["mediaFilters"]),
+        sorted(insight["sentimentFilters"]),
+    ])
+
+
+def read_high_water_mark(file, insight):
+    """Return the newest harvestTime downloaded for an insight, or None."""
+    if not Path(file).exists():
+        return None
+    with open(file) as fin:
+        state = json.load(fin)
+    return state.get(sync_key(insight))
+
+
+def write_high_water_mark(file, insight, harvest_time):
+    """Save the newest harvestTime downloaded for an insight.
+
+    Other insights recorded in the state store are kept. The store is
+    written to a temporary file first and then moved into place.
+    """
+    state = {}
+    if Path(file).exists():
+        with open(file) as fin:
+            state = json.load(fin)
+    state[sync_key(insight)] = harvest_time
+    temp_file = file + ".tmp"
+    with open(temp_file, "w") as fout:
+        json.dump(state, fout, indent=2)
+    replace(temp_file, file)
+
+
+CHECKPOINT_FILE = "documents_checkpoint.json"
+CHECKPOINT_EVERY = 10
+
+
+def save_checkpoint(
+        file, insight, end_cursor, page_count, document_count, offsets,
+        newest=None):
+    """Record how far a download has got so that it can be resumed.
+
+    The checkpoint is written to a temporary file first and then moved into
+    place, so an interrupted save never leaves a corrupt checkpoint behind.
+
+    Keyword Arguments:
+        - file -- The path of the checkpoint file.
+        - insight -- The insight being downloaded.
+        - end_cursor -- The cursor of the last page written to the CSVs.
+        - page_count -- The number of pages written to the CSVs.
+        - document_count -- The number of documents written to the CSVs.
+        - offsets -- The size in bytes of each CSV once those pages were
+            written, as returned by CSVSink.offsets().
+        - newest -- The newest harvestTime written so far, for --incremental
+            to record once the resumed download finishes.
+
+    Returns nothing.
+    """
+    checkpoint = {
+        "insight": insight,
+        "end_cursor": end_cursor,
+        "page_count": page_count,
+        "document_count": document_count,
+        "offsets": offsets,
+        "newest": newest,
+    }
+    temp_file = file + ".tmp"
+    with open(temp_file, "w") as fout:
+        json.dump(checkpoint, fout)
+        fout.flush()
+        fsync(fout.fileno())
+    replace(temp_file, file)
+
+
+def resume_checkpoint(file, insight):
+    """Load a checkpoint and roll the CSVs back to match it.
+
+    Anything written to the CSVs after the checkpoint was saved, such as a
+    partly written page, is truncated so that continuing from the saved
+    cursor does not duplicate or corrupt rows.
+
+    Keyword Arguments:
+        - file -- The path of the checkpoint file.
+        - insight -- The insight being downloaded, which must be the same
+            as the insight in the checkpoint.
+
+    Returns the checkpoint as a dictionary.
+    """
+    if not Path(file).exists():
+        raise Exception("No checkpoint found at " + file + ". Start the"
+                        + " download again without --resume.")
+    with open(file) as fin:
+        checkpoint = json.load(fin)
+    if checkpoint["insight"] != insight:
+        raise Exception("The checkpoint at " + file + " is for a different"
+                        + " insight: " + json.dumps(checkpoint["insight"]))
+    for csv_file, offset in checkpoint["offsets"].items():
+        with open(csv_file, "r+b") as fout:
+            fout.truncate(offset)
+    return checkpoint
+
+
+class _PrefixedSink:
+    """Adds the same leading columns to every row written to a sink, other
+    than rows of the dimension tables."""
+
+    def __init__(self, sink, prefix):
+        self._sink = sink
+        self._prefix = tuple(prefix)
+        self.names = getattr(sink, "names", None)
+        self.tables = getattr(sink, "tables", None)
+
+    def writerow(self, table, row):
+        if table in DIMENSION_FILES:
+            self._sink.writerow(table, row)
+        else:
+            self._sink.writerow(table, self._prefix + tuple(row))
+
+    def writerows(self, table, rows):
+        if table in DIMENSION_FILES:
+            self._sink.writerows(table, rows)
+        else:
+            self._sink.writerows(
+                table, [self._prefix + tuple(row) for row in rows])
+
+    def end_page(self):
+        self._sink.end_page()
+
+
+def make_insight(
+        focus_id, taxonomy_id, from_date, to_date, languages=(), media=(),
+        sentiments=()):
+    """Return an insight query from its fields, normalising the filters."""
+    return {
+        "focusId": focus_id,
+        "taxonomyId": taxonomy_id,
+        "fromDate": from_date,
+        "toDate": to_date,
+        "languageFilters": [language.lower() for language in languages],
+        "mediaFilters": [medium.upper() for medium in media],
+        "sentimentFilters": [sentiment.upper() for sentiment in sentiments]
+    }
+
+
+def read_batch(file):
+    """Read the insights to download in a batch from a file.
+
+    The file has one JSON object per line, blank lines are ignored. Each
+    object has the fields focus, taxonomy, from and to, which take the same
+    values as the flags of the same name, and optionally language, media
+    and sentiment, which take a list of filter values.
+
+    Returns a list of insights.
+    """
+    insights = []
+    with open(file) as fin:
+        for number, line in enumerate(fin, start=1):
+            if line.strip() == "":
+                continue
+            job = json.loads(line)
+            missing = [
+                field for field in ("focus", "taxonomy", "from", "to")
+                if field not in job]
+            if missing:
+                raise Exception("Line " + str(number) + " of " + file
+                                + " is missing: " + ", ".join(missing))
+            insights.append(make_insight(
+                job["focus"], job["taxonomy"], job["from"], job["to"],
+                job.get("language", []), job.get("media", []),
+                job.get("sentiment", [])))
+    return insights
+
+
+def batch_directory(insight):
+    """Return the name of the output directory for an insight in a batch."""
+    return "_".join((
+        insight["focusId"], insight["taxonomyId"], insight["fromDate"],
+        insight["toDate"]))
+
+
+def download_batch(
+        client, insights, workers=4, output=".", combined=False,
+        open_sink=CSVSink, tuner=None, tables=None, focus_filter=None):
+    """Download documents for many insights at once.
+
+    The insights are downloaded by a pool of worker threads sharing the
+    client, so connections and the rate limit are shared by every download.
+    Output directories, and CSV headers when writing CSVs, should already
+    have been created.
+
+    Keyword Arguments:
+        - client -- An instance of the Client class to execute the queries.
+        - insights -- A list of insights to download.
+        - workers -- The number of insights downloaded at the same time.
+            Default 4
+        - output -- The directory to write to. Unless combined, the CSVs
+            for each insight are written to a subdirectory named by
+            batch_directory().
+            Default the directory the script is called from
+        - combined -- Write every insight to the same CSVs, with an extra
+            focus_id column first.
+            Default False
+        - open_sink -- A function that takes a directory and returns a sink
+            writing to it, such as a CSVSink or an ArrowSink.
+            Default CSVSink
+        - tuner -- A PageSizeTuner shared by every download. If excluded
+            every page is client.page_size documents.
+        - tables -- The output tables the sinks write, as for
+            get_documents.
+        - focus_filter -- The type of the ids argument of the companies of
+            documents, as for get_documents.
+
+    Returns a dictionary of the number of documents downloaded for each
+    insight that succeeded and a dictionary of the exception raised for each
+    insight that failed, both keyed by position in insights.
+    """
+    write_lock = Lock()
+
+    def download(insight):
+        label = batch_directory(insight) + " "
+        pages = get_documents(
+            client, insight, label, tuner=tuner, tables=tables,
+            focus_filter=focus_filter)
+        total = 0
+        if combined:
+            sink = _PrefixedSink(combined_sink, (insight["focusId"],))
+            for page in pages:
+                with write_lock:
+                    write_docs(page, insight["focusId"], sink)
+                total += len(page)
+            return total
+        directory = Path(output) / batch_directory(insight)
+        with open_sink(directory=directory) as sink:
+            for page in pages:
+                write_docs(page, insight["focusId"], sink)
+                total += len(page)
+        return total
+
+    totals = {}
+    errors = {}
+    with ExitStack() as stack:
+        if combined:
+            combined_sink = stack.enter_context(open_sink(directory=output))
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        futures = [executor.submit(download, insight) for insight in insights]
+        for number, future in enumerate(futures):
+            try:
+                totals[number] = future.result()
+                print("FINISHED " + batch_directory(insights[number]))
+            except Exception as err:
+                errors[number] = err
+                print("FAILED " + batch_directory(insights[number]) + ": "
+                      + repr(err))
+    return totals, errors
+
+
+def _positive_int_arg(value):
+    """Validate a flag that must be a positive number."""
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise ArgumentTypeError("must be a positive number")
+
+
+def _positive_float_arg(value):
+    """Validate a flag that must be a positive number, not only a whole one."""
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0
+    if number > 0 and number != float("inf"):
+        return number
+    raise ArgumentTypeError("must be a positive number")
+
+
+def _page_size_arg(value):
+    """Validate the value of the --page-size flag."""
+    if value.isdigit() and 0 < int(value) <= MAX_PAGE_SIZE:
+        return int(value)
+    raise ArgumentTypeError(
+        "must be a number from 1 to " + str(MAX_PAGE_SIZE))
+
+
+def _shards_arg(value):
+    """Validate the value of the --shards flag."""
+    if value in ("day", "week", "auto"):
+        return value
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise ArgumentTypeError(
+        "must be day, week, auto or a positive number of shards")
+
+
+def _tables_arg(value):
+    """Validate the value of the --tables flag."""
+    tables = [table.strip() for table in value.split(",")]
+    if not all(table in CSV_FILES for table in tables):
+        raise ArgumentTypeError(
+            "must be a comma separated list of tables from: "
+            + ", ".join(CSV_FILES))
+    return tables
+
+
+def _extension(args):
+    """Return the file extension of the output format chosen by the flags."""
+    if args.format == "csv" and args.compress is not None:
+        return COMPRESSED_EXTENSIONS[args.compress]
+    if args.format == "csv":
+        return ".csv"
+    if args.format == "sqlite":
+        return ".sqlite"
+    return ArrowSink.extensions[args.format]
+
+
+def _existing_files(args, directory="."):
+    """Return the output files of the format chosen by the flags that are
+    already present in a directory."""
+    if args.format == "sqlite":
+        # Every table is written to the same database, whichever are chosen.
+        if (Path(directory) / SQLITE_FILE).exists():
+            return [SQLITE_FILE]
+        return []
+    return existing_csvs(
+        directory, _extension(args), args.normalise, args.tables)
+
+
+def _open_sink(args, directory=".", extra_columns=()):
+    """Return a sink for the output format chosen by the flags."""
+    if args.format == "csv":
+        return CSVSink(
+            args.buffer_size, directory, args.normalise, args.compress,
+            args.tables)
+    if args.format == "sqlite":
+        append = args.append or args.resume or args.incremental
+        return SQLiteSink(
+            directory, extra_columns, args.normalise, replace=not append,
+            tables=args.tables)
+    return ArrowSink(
+        args.format, args.pages_per_group, directory, extra_columns,
+        args.normalise, args.tables)
+
+
+def _main_batch(args):
+    """Run the download for the --batch flag."""
+    insights = read_batch(args.batch)
+    directories = [batch_directory(insight) for insight in insights]
+    if args.combined:
+        directories = ["."]
+    elif len(set(directories)) != len(directories):
+        raise Exception("Insights in a batch must have different focus,"
+                        + " taxonomy or dates. Use --combined to download"
+                        + " insights that only differ by filters.")
+    extra_columns = ("focus_id",) if args.combined else ()
+    for directory in directories:
+        directory = Path(args.output) / directory
+        directory.mkdir(parents=True, exist_ok=True)
+        existing_files = []
+        if not args.overwrite:
+            existing_files = _existing_files(args, directory)
+            if not args.append and len(existing_files) != 0:
+                raise Exception("Files already exist in " + str(directory)
+                                + ": " + ", ".join(existing_files)
+                                + ". Use --overwrite to overwrite existing"
+                                + " files or use --append to append to"
+                                + " existing files.")
+        if args.format == "csv":
+            check_appendable(existing_files, directory, args.compress)
+            write_all_headers(
+                existing_files, directory, extra_columns, args.normalise,
+                args.compress, args.tables)
+
+    tuner = None
+    if args.adaptive_page_size:
+        tuner = PageSizeTuner(initial=args.page_size)
+    client = Client(
+        page_size=args.page_size, pool_size=args.workers,
+        rate_limiter=RateLimiter(args.rate, lock_file=args.rate_lock))
+    focus_filter = None
+    if selects_companies(args.tables):
+        focus_filter = focus_filter_type(client)
+    totals, errors = download_batch(
+        client, insights, args.workers, args.output, args.combined,
+        partial(_open_sink, args, extra_columns=extra_columns), tuner,
+        args.tables, focus_filter)
+
+    print("FINISHED")
+    print("Total of " + str(sum(totals.values())) + " documents matched for "
+          + str(len(totals)) + " of " + str(len(insights)) + " insights.")
+    if errors:
+        raise Exception(str(len(errors)) + " insights failed: " + ", ".join(
+            batch_directory(insights[number]) for number in errors))
 
 
 def main():
@@ -324,7 +1614,8 @@ def main():
         prog="CSV Download",
         description="""Save documents matching an insight query in CSVs.\n
         The arguments are the same as the fields of an insight query.\n
-        The arguments focus, taxonomy, from and to are required.\n
+        The arguments focus, taxonomy, from and to are required unless
+        a --batch file is given.\n
         The filter arguments: language, media and sentiment are optional.\n
         To specify multiple filters of a certain type repeat that flag.\n
         See https://developer.polecat.com/reference/enums for valid filter values.
@@ -342,8 +1633,7 @@ def main():
                         Polecat API by executing the companies query.
 
                         """),
-                        type=str,
-                        required=True)
+                        type=str)
     parser.add_argument("--taxonomy",
                         dest="taxonomy_id",
                         help=dedent("""\
@@ -353,8 +1643,7 @@ def main():
                         Polecat API by executing the myOrganisation query.
 
                         """),
-                        type=str,
-                        required=True)
+                        type=str)
     parser.add_argument("--from",
                         dest="from_date",
                         help=dedent("""\
@@ -363,8 +1652,7 @@ def main():
                         will be included. The date format is yyyy-mm-dd.
 
                         """),
-                        type=str,
-                        required=True)
+                        type=str)
     parser.add_argument("--to",
                         dest="to_date",
                         help=dedent("""\
@@ -373,8 +1661,7 @@ def main():
                         will be included. The date format is yyyy-mm-dd.
 
                         """),
-                        type=str,
-                        required=True)
+                        type=str)
     parser.add_argument("--language",
                         help=dedent("""\
                         OPTIONAL. The 2 character code for the language
@@ -421,48 +1708,449 @@ def main():
 
                         """),
                         action="store_true")
+    parser.add_argument("--incremental",
+                        help=dedent("""\
+                        OPTIONAL. Only download documents harvested since
+                        the last incremental run for the same focus, taxonomy
+                        and filters, appending them to the existing CSVs.
+                        The newest harvest time downloaded is recorded in the
+                        --state file. Cannot be used with --shards.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--state",
+                        help=dedent("""\
+                        OPTIONAL. The file recording the progress of
+                        incremental runs.
+                        Default sync_state.json
+
+                        """),
+                        type=str,
+                        default=SYNC_STATE_FILE)
+    parser.add_argument("--resume",
+                        help=dedent("""\
+                        OPTIONAL. Continue a download that was stopped
+                        part way through from its last checkpoint. The same
+                        insight arguments must be given as for the original
+                        download. Cannot be used with --shards.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--checkpoint-every",
+                        help=dedent("""\
+                        OPTIONAL. How many pages to write between saving
+                        checkpoints that --resume can continue from.
+                        Default 10
+
+                        """),
+                        type=_positive_int_arg)
+    parser.add_argument("--batch",
+                        help=dedent("""\
+                        OPTIONAL. Download many insights at once from a
+                        file with one JSON object per line, each with the
+                        fields focus, taxonomy, from and to and optionally
+                        lists of language, media and sentiment filters. The
+                        insights are downloaded --workers at a time.
+
+                        """),
+                        type=str)
+    parser.add_argument("--output",
+                        help=dedent("""\
+                        OPTIONAL. The directory to write a --batch to.
+                        Each insight is written to its own subdirectory
+                        unless --combined is used.
+                        Default the current directory
+
+                        """),
+                        type=str,
+                        default=".")
+    parser.add_argument("--combined",
+                        help=dedent("""\
+                        OPTIONAL. Write every insight in a --batch to the
+                        same CSVs, with an extra focus_id column.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--shards",
+                        help=dedent("""\
+                        OPTIONAL. Split the date range into shards that
+                        are downloaded concurrently. Either "day", "week",
+                        a number of equally sized shards or "auto" to split
+                        busy periods of the range into smaller shards.
+                        Documents are written in the order they are received
+                        rather than by date.
+
+                        """),
+                        type=_shards_arg)
+    parser.add_argument("--workers",
+                        help=dedent("""\
+                        OPTIONAL. The number of shards to download at the
+                        same time when using --shards.
+                        Default 4
+
+                        """),
+                        type=_positive_int_arg,
+                        default=4)
+    parser.add_argument("--page-size",
+                        help=dedent("""\
+                        OPTIONAL. The number of documents to request
+                        at a time, at most 1000.
+                        Default 100
+
+                        """),
+                        type=_page_size_arg,
+                        default=100)
+    parser.add_argument("--adaptive-page-size",
+                        help=dedent("""\
+                        OPTIONAL. Adjust the number of documents requested
+                        at a time to how quickly the API is responding,
+                        starting from --page-size. Cannot be used with
+                        --stream.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--rate",
+                        help=dedent("""\
+                        OPTIONAL. The maximum number of requests per
+                        second to send to the API. Requests are paced to stay
+                        under this rate instead of waiting to be rate limited.
+
+                        """),
+                        type=_positive_float_arg)
+    parser.add_argument("--rate-lock",
+                        help=dedent("""\
+                        OPTIONAL. A file used to share the --rate limit
+                        between all the scripts given the same file, such as
+                        several downloads and searches running at once.
+
+                        """),
+                        type=str)
+    parser.add_argument("--prefetch",
+                        help=dedent("""\
+                        OPTIONAL. Request the next pages while the
+                        current page is written, keeping up to this many
+                        downloaded pages waiting to be written. Downloading
+                        pauses whenever writing falls this far behind.
+                        Default 0 (pages are downloaded then written in turn)
+
+                        """),
+                        type=int,
+                        default=0)
+    parser.add_argument("--writer-queue",
+                        help=dedent("""\
+                        OPTIONAL. Write pages on a separate thread so that
+                        slow disks don't hold up downloading, keeping up to
+                        this many downloaded pages waiting to be written.
+                        Downloading pauses whenever writing falls this far
+                        behind. If writing fails the download stops with
+                        the error. Cannot be used with --stream.
+                        Default 0 (pages are written as they arrive)
+
+                        """),
+                        type=int,
+                        default=0)
+    parser.add_argument("--stream",
+                        help=dedent("""\
+                        OPTIONAL. Decode and write documents one at a
+                        time as they are received instead of a page at a
+                        time, keeping memory use low for large pages. Cannot
+                        be used with --shards, --prefetch, --dedup,
+                        --incremental or --writer-queue.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--format",
+                        help=dedent("""\
+                        OPTIONAL. The format to write documents in. One of
+                        csv, parquet, arrow (Arrow IPC) or sqlite (a SQLite
+                        database, documents.sqlite, with a table for each
+                        CSV). The parquet and arrow formats need the pyarrow
+                        package and cannot be used with --append, --resume
+                        or --incremental.
+                        Default csv
+
+                        """),
+                        choices=("csv", "parquet", "arrow", "sqlite"),
+                        default="csv")
+    parser.add_argument("--pages-per-group",
+                        help=dedent("""\
+                        OPTIONAL. The number of pages of documents in each
+                        row group of the parquet and arrow formats.
+                        Default 10
+
+                        """),
+                        type=_positive_int_arg,
+                        default=10)
+    parser.add_argument("--tables",
+                        help=dedent("""\
+                        OPTIONAL. A comma separated list of the tables to
+                        write, from documents, denormalised, companies and
+                        topics, e.g. documents,topics. Only the document
+                        fields these tables need are downloaded. Use the
+                        same tables every time when appending.
+                        Default all of them
+
+                        """),
+                        type=_tables_arg)
+    parser.add_argument("--normalise",
+                        help=dedent("""\
+                        OPTIONAL. Write each company and topic name once,
+                        to companies.csv and topics.csv, instead of on every
+                        row. The other CSVs only have company and topic ids.
+                        Use the flag every time when appending to the same
+                        CSVs.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--compress",
+                        help=dedent("""\
+                        OPTIONAL. Compress the CSVs as they are written,
+                        with gzip or zstd, naming them .csv.gz or .csv.zst.
+                        Appending adds to the compressed CSVs. zstd needs
+                        the zstandard package.
+
+                        """),
+                        choices=("gzip", "zstd"))
+    parser.add_argument("--dedup",
+                        help=dedent("""\
+                        OPTIONAL. Only write each document once, skipping
+                        documents with the same id as one already written.
+                        When appending, the ids already in documents.csv are
+                        skipped too. Cannot be used with --batch or --stream.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--bloom-capacity",
+                        help=dedent("""\
+                        OPTIONAL. With --dedup, remember document ids in a
+                        bloom filter sized for this many documents instead of
+                        keeping every id, using much less memory for huge
+                        downloads. Around 1 in 1000 new documents will
+                        wrongly be skipped as already written. The ids
+                        already in documents.csv count towards the capacity,
+                        and the filter grows if it is exceeded.
+
+                        """),
+                        type=_positive_int_arg)
+    parser.add_argument("--metrics",
+                        help=dedent("""\
+                        OPTIONAL. A file to write timings and sizes for
+                        each page to, as JSON lines: request latency, bytes
+                        received, JSON decode, write and rate limit wait
+                        times and rows written. Cannot be used with --batch.
+
+                        """),
+                        type=str)
+    parser.add_argument("--timings",
+                        help=dedent("""\
+                        OPTIONAL. Print a summary of the time spent in each
+                        stage of the download when it finishes. Cannot be
+                        used with --batch.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--buffer-size",
+                        help=dedent("""\
+                        OPTIONAL. The number of rows to buffer for each
+                        CSV before writing them to disk.
+                        Default 1000
+
+                        """),
+                        type=int,
+                        default=1000)
     args = parser.parse_args()
+    if args.format in ArrowSink.extensions and (
+            args.append or args.resume or args.incremental):
+        parser.error("--format " + args.format + " cannot be used with"
+                     " --append, --resume or --incremental")
+    if args.format != "csv" and args.compress is not None:
+        parser.error("--compress can only be used with --format csv")
+    if args.bloom_capacity is not None and not args.dedup:
+        parser.error("--bloom-capacity can only be used with --dedup")
+    if args.batch is not None:
+        if args.resume or args.incremental or args.stream or args.dedup or (
+                args.shards is not None or args.metrics is not None
+                or args.timings or args.writer_queue > 0
+                or args.prefetch > 0 or args.checkpoint_every is not None):
+            parser.error("--batch cannot be used with --resume, --incremental,"
+                         " --stream, --dedup, --shards, --metrics, --timings,"
+                         " --writer-queue, --prefetch or --checkpoint-every")
+        return _main_batch(args)
+    missing = [
+        flag for flag, value in (
+            ("--focus", args.focus_id), ("--taxonomy", args.taxonomy_id),
+            ("--from", args.from_date), ("--to", args.to_date))
+        if value is None]
+    if missing:
+        parser.error(
+            "the following arguments are required: " + ", ".join(missing))
+    if args.resume and args.shards is not None:
+        parser.error("--resume cannot be used with --shards")
+    if args.checkpoint_every is None:
+        args.checkpoint_every = CHECKPOINT_EVERY
+    if args.incremental and args.shards is not None:
+        parser.error("--incremental cannot be used with --shards")
+    if args.stream and (args.shards is not None or args.prefetch > 0):
+        parser.error("--stream cannot be used with --shards or --prefetch")
+    if args.stream and args.adaptive_page_size:
+        parser.error("--stream cannot be used with --adaptive-page-size")
+    if args.stream and args.dedup:
+        parser.error("--stream cannot be used with --dedup")
+    if args.stream and args.incremental:
+        parser.error("--stream cannot be used with --incremental")
+    if args.stream and args.writer_queue > 0:
+        parser.error("--stream cannot be used with --writer-queue")
+    if args.dedup and args.tables is not None and (
+            "documents" not in args.tables):
+        parser.error("--dedup needs the documents table in --tables")
 
-    if not args.overwrite:
-        existing_files = []
-        for csv_type in ["", "_denormalised", "_companies", "_topics"]:
-            file = Path("documents" + csv_type + ".csv")
-            if file.exists():
-                existing_files += [file.name]
-        if not args.append and len(existing_files) != 0:  
+    existing_files = []
+    if args.resume:
+        existing_files = [
+            csv_name(file, args.compress)
+            for file in output_files(args.normalise, args.tables).values()]
+    elif not args.overwrite:
+        existing_files = _existing_files(args)
+        if not (args.append or args.incremental) and len(existing_files) != 0:
             raise Exception("Files already exist: " + ", ".join(existing_files)
                             + ". Use --overwrite to overwrite existing files" 
                             + " or use --append to append to existing files.")
 
-    insight = {
-        "focusId": args.focus_id,
-        "taxonomyId": args.taxonomy_id,
-        "fromDate": args.from_date,
-        "toDate": args.to_date,
-        "languageFilters": [language.lower() for language in args.language],
-        "mediaFilters": [media.upper() for media in args.media],
-        "sentimentFilters": [sentiment.upper() for sentiment in args.sentiment]
-    }
+    insight = make_insight(
+        args.focus_id, args.taxonomy_id, args.from_date, args.to_date,
+        args.language, args.media, args.sentiment)
 
-    client = Client()
+    mark = None
+    if args.incremental:
+        mark = read_high_water_mark(args.state, insight)
+    if mark is not None:
+        print("DOWNLOADING DOCUMENTS HARVESTED AFTER " + mark)
+        insight["fromDate"] = max(insight["fromDate"], mark[:10])
 
-    docs = get_documents(client, insight)
+    checkpoint = None
+    if args.resume:
+        checkpoint = resume_checkpoint(CHECKPOINT_FILE, insight)
+        print("RESUMING AFTER PAGE " + str(checkpoint["page_count"]))
 
-    total_docs = 0
-    append = args.append
-    if append:
-        write_all_headers(existing_files)
+    rate_limiter = RateLimiter(args.rate, lock_file=args.rate_lock)
+    tuner = None
+    if args.adaptive_page_size:
+        tuner = PageSizeTuner(initial=args.page_size)
+    if args.shards is None:
+        client = Client(page_size=args.page_size, rate_limiter=rate_limiter)
     else:
-        write_all_headers([])
-    for page in docs:
-        print("WRITING...")
-        write_docs(page, args.focus_id)
-        print("...WRITTEN")
-        total_docs += len(page)
-        append = True
+        client = Client(
+            page_size=args.page_size, pool_size=args.workers,
+            rate_limiter=rate_limiter)
+    focus_filter = None
+    if selects_companies(args.tables):
+        focus_filter = focus_filter_type(client)
+    if args.shards is not None:
+        docs = get_documents_sharded(
+            client, insight, args.shards, args.workers, tuner, args.tables,
+            focus_filter)
+    elif checkpoint is None:
+        docs = get_documents(
+            client, insight, stream=args.stream, tuner=tuner,
+            tables=args.tables, focus_filter=focus_filter)
+    else:
+        docs = get_documents(
+            client, insight, after=checkpoint["end_cursor"],
+            page_count=checkpoint["page_count"] + 1, stream=args.stream,
+            tuner=tuner, tables=args.tables, focus_filter=focus_filter)
+    metrics = None
+    if args.metrics is not None or args.timings:
+        metrics = PageMetrics(args.metrics)
+        client.hooks.append(metrics.hook)
+    if mark is not None:
+        docs = newer_documents(docs, mark)
+    if args.dedup:
+        seen = set()
+        if args.bloom_capacity is not None:
+            seen = BloomFilter(args.bloom_capacity)
+        documents_file = csv_name(CSV_FILES["documents"], args.compress)
+        if (args.append or args.resume or args.incremental) and (
+                documents_file in existing_files):
+            read_document_ids(documents_file, seen, args.compress)
+        docs = unique_documents(docs, seen)
+    if args.prefetch > 0:
+        docs = prefetch(docs, args.prefetch)
+
+    total_docs = 0
+    if checkpoint is not None:
+        total_docs = checkpoint["document_count"]
+    newest = mark
+    if checkpoint is not None and checkpoint.get("newest") is not None:
+        # Checkpoints from older versions don't have it.
+        newest = checkpoint["newest"]
+    append = args.append or args.resume or args.incremental
+    if args.format == "csv" and append:
+        check_appendable(existing_files, compression=args.compress)
+        write_all_headers(
+            existing_files, normalised=args.normalise,
+            compression=args.compress, tables=args.tables)
+    elif args.format == "csv":
+        write_all_headers(
+            [], normalised=args.normalise, compression=args.compress,
+            tables=args.tables)
+    # Checkpoints rely on the CSVs being appended to in order, or on the
+    # database upserting any pages written again.
+    checkpointing = args.shards is None and args.format in ("csv", "sqlite")
+    # The time taken to fetch each page waiting to be written.
+    fetch_times = deque()
+    with _open_sink(args) as sink:
+        writer = sink
+        if metrics is not None:
+            writer = metrics.count_rows(sink)
+        if checkpointing and checkpoint is None:
+            save_checkpoint(
+                CHECKPOINT_FILE, insight, None, 0, 0, sink.offsets(), newest)
+
+        # Called once each page is written, from the writer thread when
+        # there is one, so checkpoints only cover pages in the files.
+        def page_written(page, measurements):
+            nonlocal total_docs, newest
+            print("...WRITTEN")
+            total_docs += len(page)
+            if args.incremental and len(page) > 0:
+                page_newest = max(
+                    (doc["harvestTime"] for doc in page),
+                    key=parse_harvest_time)
+                if newest is None or (parse_harvest_time(page_newest)
+                                      > parse_harvest_time(newest)):
+                    newest = page_newest
+            fetch_time = fetch_times.popleft()
+            if checkpointing and page.number % args.checkpoint_every == 0:
+                save_checkpoint(
+                    CHECKPOINT_FILE, insight, page.end_cursor, page.number,
+                    total_docs, sink.offsets(), newest)
+            if metrics is not None:
+                metrics.page(page, fetch_time, **measurements)
+
+        with PageWriter(
+                writer, args.focus_id, args.writer_queue,
+                page_written) as page_writer:
+            fetch_start = time()
+            for page in docs:
+                fetch_times.append(time() - fetch_start)
+                print("WRITING...")
+                page_writer.write(page)
+                fetch_start = time()
+    if checkpointing:
+        Path(CHECKPOINT_FILE).unlink()
+    if args.incremental and newest is not None:
+        write_high_water_mark(args.state, insight, newest)
 
     print("FINISHED")
     print("Total of " + str(total_docs) + " documents matched.")
+    if client.bytes_decoded > 0:
+        print("Received {:.2f} MB, {:.2f} MB after decompression ({:.0%} saved)."
+              .format(client.bytes_received / 1e6, client.bytes_decoded / 1e6,
+                      1 - client.bytes_received / client.bytes_decoded))
+    if metrics is not None:
+        metrics.close()
+        if args.timings:
+            metrics.output_summary()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,177 @@
+import json
+from threading import Lock
+
+
+class _CountingSink:
+    """Counts the rows written to each table of a sink."""
+
+    def __init__(self, sink):
+        self._sink = sink
+        self.names = getattr(sink, "names", None)
+        self.tables = getattr(sink, "tables", None)
+        self.rows = {}
+
+    def writerow(self, table, row):
+        self.rows[table] = self.rows.get(table, 0) + 1
+        self._sink.writerow(table, row)
+
+    def writerows(self, table, rows):
+        self.rows[table] = self.rows.get(table, 0) + len(rows)
+        self._sink.writerows(table, rows)
+
+    def end_page(self):
+        self._sink.end_page()
+
+
+class PageMetrics:
+    """Measures where the time goes in a download, page by page.
+
+    Add hook to the hooks of the Client making the requests, write the
+    pages to the sink returned by count_rows() and call page() after each
+    page is written. Requests reported to the hook are counted towards the
+    next page recorded, so when pages are fetched concurrently, with
+    shards or prefetching, the request figures of a page are only
+    approximate. Streamed requests finish after their page is written and
+    so are counted towards the page after. The totals are exact once the
+    metrics are closed.
+
+    Keyword Arguments:
+        - file -- The path of a file to write the measurements of each page
+            to, as a line of JSON. If excluded they are only totalled.
+
+    Attributes:
+        - totals -- The measurements of every page added together.
+
+    Methods:
+        - hook(event, details) -- A Client hook recording each request.
+        - count_rows(sink) -- Return a sink that counts the rows written to
+            each table before passing them on to sink.
+        - page(page, fetch_time, write_time, queue_depth, writer_lag) --
+            Record a page that took fetch_time seconds to arrive and
+            write_time seconds to write. With a PageWriter, also the pages
+            waiting to be written when it was given and the seconds until
+            it was written.
+        - output_summary() -- Print a table of the time spent in each stage.
+        - close() -- Add any requests not yet counted towards a page to the
+            totals and close the file.
+
+    The measurements of a page are:
+        - page -- The number of the page.
+        - documents -- The number of documents in the page.
+        - requests -- The number of successful requests.
+        - retries -- The number of 429 responses.
+        - fetch_time -- Seconds spent waiting for the page.
+        - latency -- Seconds from sending requests to reading responses.
+        - bytes_received -- Response bytes received, before decompression.
+        - bytes_decoded -- Response bytes after decompression.
+        - decode_time -- Seconds spent parsing JSON responses. Streamed
+            responses are parsed while they are written instead.
+        - wait -- Seconds slept before requests to keep to the rate limit.
+        - retry_after -- Seconds 429 responses asked to wait.
+        - write_time -- Seconds spent writing the page.
+        - queue_depth -- The number of pages waiting to be written when the
+            page was given to the writer. The totals have the most pages
+            that waited.
+        - writer_lag -- Seconds from the page being given to the writer to
+            it being written.
+        - rows -- The number of rows written to each table.
+    """
+
+    _request_fields = (
+        "latency", "bytes_received", "bytes_decoded", "decode_time", "wait")
+
+    def __init__(self, file=None):
+        self._file = None if file is None else open(file, "w")
+        self._lock = Lock()
+        self._pending = self._empty_requests()
+        self._counter = None
+        self.totals = dict(
+            self._empty_requests(), pages=0, documents=0, fetch_time=0,
+            write_time=0, queue_depth=0, writer_lag=0, rows={})
+
+    def _empty_requests(self):
+        return dict(
+            {field: 0 for field in self._request_fields},
+            requests=0, retries=0, retry_after=0)
+
+    def hook(self, event, details):
+        """Record a request reported by a Client."""
+        with self._lock:
+            if event == "response":
+                self._pending["requests"] += 1
+                for field in self._request_fields:
+                    self._pending[field] += details[field] or 0
+            elif event == "retry":
+                self._pending["retries"] += 1
+                self._pending["retry_after"] += details["retry_after"]
+
+    def count_rows(self, sink):
+        """Return a sink counting the rows written to sink for each page."""
+        self._counter = _CountingSink(sink)
+        return self._counter
+
+    def page(
+            self, page, fetch_time, write_time, queue_depth=0,
+            writer_lag=None):
+        """Record the measurements of a page once it has been written."""
+        if writer_lag is None:
+            writer_lag = write_time
+        with self._lock:
+            requests, self._pending = self._pending, self._empty_requests()
+        rows = {}
+        if self._counter is not None:
+            rows, self._counter.rows = self._counter.rows, {}
+        measurements = dict(
+            {"page": page.number, "documents": len(page)}, **requests,
+            fetch_time=fetch_time, write_time=write_time,
+            queue_depth=queue_depth, writer_lag=writer_lag, rows=rows)
+        self._add_to_totals(measurements)
+        self.totals["pages"] += 1
+        if self._file is not None:
+            self._file.write(json.dumps(measurements) + "\n")
+            self._file.flush()
+        return measurements
+
+    def _add_to_totals(self, measurements):
+        for field, value in measurements.items():
+            if field == "rows":
+                for table, count in value.items():
+                    self.totals["rows"][table] = (
+                        self.totals["rows"].get(table, 0) + count)
+            elif field == "queue_depth":
+                self.totals[field] = max(self.totals[field], value)
+            elif field != "page":
+                self.totals[field] += value
+
+    def output_summary(self):
+        """Print a table of the time spent in each stage of the download."""
+        totals = self.totals
+        pages = max(totals["pages"], 1)
+        print("{:<26} {:>10} {:>12}".format("STAGE", "SECONDS", "MS PER PAGE"))
+        for name, seconds in (
+                ("waiting for pages", totals["fetch_time"]),
+                ("  request latency", totals["latency"]),
+                ("  json decode", totals["decode_time"]),
+                ("  rate limit sleep", totals["wait"]),
+                ("writing", totals["write_time"])):
+            print("{:<26} {:>10.2f} {:>12.1f}".format(
+                name, seconds, seconds / pages * 1000))
+        print("Pages: {}, requests: {}, 429 retries: {} ({} s asked to wait)"
+              .format(totals["pages"], totals["requests"], totals["retries"],
+                      totals["retry_after"]))
+        print("Received {:.2f} MB, {:.2f} MB decoded".format(
+            totals["bytes_received"] / 1e6, totals["bytes_decoded"] / 1e6))
+        print("Writer lag: {:.1f} ms per page, at most {} pages waiting"
+              .format(totals["writer_lag"] / pages * 1000,
+                      totals["queue_depth"]))
+        print("Rows: " + ", ".join(
+            table + " " + str(count)
+            for table, count in totals["rows"].items()))
+
+    def close(self):
+        """Count any remaining requests in the totals and close the file."""
+        with self._lock:
+            requests, self._pending = self._pending, self._empty_requests()
+        self._add_to_totals(requests)
+        if self._file is not None:
+            self._file.close()
@@ -0,0 +1,542 @@
+import gzip
+import json
+import re
+import zlib
+from argparse import ArgumentParser, RawTextHelpFormatter
+from base64 import b64decode, b64encode
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from textwrap import dedent
+from threading import Lock, Thread
+from time import sleep
+
+
+_WORDS = (
+    "global", "north", "united", "digital", "green", "capital", "pacific",
+    "energy", "systems", "health", "motors", "foods", "media", "logistics",
+    "holdings", "partners", "bank", "pharma", "retail", "networks",
+)
+
+_SOURCES = ("NEWS", "BLOGS", "SOCIAL", "FORUMS")
+_SENTIMENTS = ("POSITIVE", "NEUTRAL", "NEGATIVE")
+
+
+def encode_cursor(offset):
+    """Return an opaque cursor for a position in a list of results."""
+    return b64encode(("offset:" + str(offset)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the position in a list of results that a cursor is for."""
+    if cursor is None:
+        return 0
+    return int(b64decode(cursor).decode().split(":")[1])
+
+
+def _parse_selection(tokens):
+    """Parse the fields of a selection set from tokens after its "{"."""
+    fields = {}
+    field = None
+    for token in tokens:
+        if token == "}":
+            break
+        if token == "{":
+            fields[field] = _parse_selection(tokens)
+        elif token == "(":
+            # Arguments don't change which fields are returned.
+            for token in tokens:
+                if token == ")":
+                    break
+        else:
+            field = token
+            fields[field] = None
+    return fields
+
+
+def node_selection(query):
+    """Return the fields selected on the nodes of a query.
+
+    Returns a dictionary of each field selected to a dictionary of the
+    fields selected on it, or to None if it is a scalar. Returns None if
+    the query doesn't select nodes.
+    """
+    start = query.find("node")
+    if start == -1:
+        return None
+    tokens = iter(re.findall(r"[{}()]|\w+", query[start + len("node"):]))
+    if next(tokens, None) != "{":
+        return None
+    return _parse_selection(tokens)
+
+
+def project(value, selection):
+    """Return only the selected fields of a value, as GraphQL would."""
+    if selection is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, selection) for item in value]
+    return {
+        field: project(value[field], fields)
+        for field, fields in selection.items() if field in value}
+
+
+class MockAPI:
+    """A local stand-in for the Polecat GraphQL API.
+
+    Answers the documents, companies and myOrganisation.taxonomies queries
+    with generated data that has the same shape as the real API's, paged
+    with cursors. Queries are recognised by the fields they select rather
+    than being parsed, and the insight filters are ignored, but only the
+    fields selected on documents are returned. The companies of documents
+    can be filtered with an ids argument of type [ID!], given as the
+    companyIds variable, which is reported by introspecting the Document
+    type. The same
+    insight always returns the same documents, newest first.
+
+    Keyword Arguments:
+        - documents_per_day -- The number of documents matching an insight
+            on each day of its date range.
+            Default 100
+        - document_size -- The approximate size in bytes of each document
+            in a response, made up by padding its title.
+            Default 1000
+        - company_count -- The number of companies to search through.
+            Default 10000
+        - latency -- The time in seconds to wait before every response.
+            Default 0
+        - jitter -- A random extra wait of up to this many seconds before
+            every response.
+            Default 0
+        - rate_limit -- The chance, from 0 to 1, of answering a request
+            with a 429 response instead.
+            Default 0
+        - retry_after -- The Retry-After header of 429 responses in seconds.
+            Default 1
+        - max_page_size -- The most results returned in one page, however
+            many are asked for.
+            Default 1000
+        - companies_per_document -- The number of companies each document
+            mentions, including the focus company.
+            Default 2
+        - company_filter -- Support the ids argument of the companies of
+            documents.
+            Default True
+        - seed -- Seeds the random latency and 429 responses.
+            Default None
+
+    Attributes:
+        - requests -- The number of requests answered.
+        - rate_limited -- The number of 429 responses given.
+
+    Methods:
+        - respond(body, accept_encoding) -- Answer a request body, returning
+            the status, headers and body of the response.
+    """
+
+    def __init__(
+            self, documents_per_day=100, document_size=1000,
+            company_count=10000, latency=0, jitter=0, rate_limit=0,
+            retry_after=1, max_page_size=1000, companies_per_document=2,
+            company_filter=True, seed=None):
+        self.documents_per_day = documents_per_day
+        self.document_size = document_size
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.max_page_size = max_page_size
+        self.companies_per_document = companies_per_document
+        self.company_filter = company_filter
+        self.requests = 0
+        self.rate_limited = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._companies = [
+            {"id": "c{:07d}".format(number), "name": self._company_name(number)}
+            for number in range(company_count)]
+
+    def _company_name(self, number):
+        first = _WORDS[number % len(_WORDS)]
+        second = _WORDS[number // len(_WORDS) % len(_WORDS)]
+        return "{} {} {}".format(first, second, number).title()
+
+    def _document(self, insight, day, number):
+        """Return the document at a position in a day of results."""
+        document_id = "d{}{:05d}".format(day.strftime("%Y%m%d"), number)
+        spacing = 86400 / self.documents_per_day
+        harvest_time = datetime(day.year, day.month, day.day, 23, 59, 59) - (
+            timedelta(seconds=int(number * spacing)))
+        title = "Document " + document_id
+        padding = self.document_size - 540 - len(title)
+        if padding > 0:
+            words = []
+            while padding > 0:
+                word = _WORDS[(number + len(words)) % len(_WORDS)]
+                words.append(word)
+                padding -= len(word) + 1
+            title += " " + " ".join(words)
+        topics = [
+            {
+                "topic": {
+                    "id": "{}-t{}".format(insight["taxonomyId"], topic),
+                    "name": "Topic " + str(topic),
+                },
+                "significance": round(0.9 - 0.2 * topic, 2),
+            }
+            for topic in range(number % 4)]
+        others = [
+            self._companies[(number + other) % len(self._companies)] if (
+                self._companies) else {"id": "c0", "name": "Other"}
+            for other in range(self.companies_per_document - 1)]
+        return {
+            "id": document_id,
+            "harvestTime": harvest_time.isoformat() + "Z",
+            "title": title,
+            "domain": "example.com",
+            "url": "https://example.com/" + document_id,
+            "source": _SOURCES[number % len(_SOURCES)],
+            "publisher": "Publisher " + str(number % 50),
+            "reach": number * 100,
+            "sentiment": _SENTIMENTS[number % len(_SENTIMENTS)],
+            "companies": [
+                {
+                    "company": {
+                        "id": insight["focusId"],
+                        "name": "Focus " + insight["focusId"],
+                    },
+                    "significance": 0.8,
+                },
+            ] + [
+                {"company": other, "significance": 0.2} for other in others
+            ],
+            "topics": topics,
+        }
+
+    def documents(self, variables, selection=None, company_ids=None):
+        """Return a page of the documents matching an insight, with only
+        the fields of selection, from node_selection(), if given, and only
+        the companies in company_ids, if given."""
+        insight = variables["insight"]
+        from_date = date.fromisoformat(insight["fromDate"])
+        to_date = date.fromisoformat(insight["toDate"])
+        total = ((to_date - from_date).days + 1) * self.documents_per_day
+        start = decode_cursor(variables.get("after"))
+        end = min(
+            start + min(variables["first"], self.max_page_size), max(total, 0))
+        edges = []
+        for offset in range(start, end):
+            day = to_date - timedelta(days=offset // self.documents_per_day)
+            document = self._document(
+                insight, day, offset % self.documents_per_day)
+            if company_ids is not None:
+                document["companies"] = [
+                    company for company in document["companies"]
+                    if company["company"]["id"] in company_ids]
+            edges.append({"node": project(document, selection)})
+        return {"documents": {
+            "edges": edges,
+            "pageInfo": {
+                "endCursor": encode_cursor(max(start, end)),
+                "hasNextPage": end < total,
+            },
+        }}
+
+    def companies(self, variables):
+        """Return a page of the companies with names containing search."""
+        search = (variables.get("search") or "").lower()
+        matches = [
+            company for company in self._companies
+            if search in company["name"].lower()]
+        start = decode_cursor(variables.get("after"))
+        end = min(
+            start + min(variables["first"], self.max_page_size), len(matches))
+        return {"companies": {
+            "edges": [{"node": company} for company in matches[start:end]],
+            "pageInfo": {
+                "endCursor": encode_cursor(max(start, end)),
+                "hasNextPage": end < len(matches),
+            },
+        }}
+
+    def document_type(self):
+        """Return the fields of the Document type and their arguments."""
+        fields = [
+            {"name": name, "args": []} for name in (
+                "id", "harvestTime", "title", "domain", "url", "source",
+                "publisher", "reach", "sentiment", "companies", "topics")]
+        if self.company_filter:
+            fields[-2]["args"].append({"name": "ids", "type": {
+                "kind": "LIST", "name": None, "ofType": {
+                    "kind": "NON_NULL", "name": None, "ofType": {
+                        "kind": "SCALAR", "name": "ID", "ofType": None}}}})
+        return {"__type": {"name": "Document", "fields": fields}}
+
+    def taxonomies(self, variables):
+        """Return the taxonomies of the organisation."""
+        return {"myOrganisation": {"taxonomies": [
+            {"id": "tax{}".format(number), "name": "Taxonomy " + str(number)}
+            for number in range(3)]}}
+
+    def _answer(self, body):
+        """Return the GraphQL response to a request body."""
+        try:
+            request = json.loads(body)
+            query = request["query"]
+            variables = request.get("variables") or {}
+        except (ValueError, KeyError, TypeError):
+            return {"errors": [{"message": "Invalid GraphQL request"}]}
+        try:
+            if "__type" in query:
+                return {"data": self.document_type()}
+            if "documents(" in query:
+                company_ids = None
+                if "companies(ids:" in query:
+                    if not self.company_filter:
+                        return {"errors": [{"message": "Unknown argument"
+                                            + " ids on field companies"}]}
+                    if "$companyIds: [ID!]" not in query:
+                        return {"errors": [{"message": "Variable companyIds"
+                                            + " must be of type [ID!]"}]}
+                    company_ids = variables["companyIds"]
+                    if isinstance(company_ids, str):
+                        company_ids = [company_ids]
+                return {"data": self.documents(
+                    variables, node_selection(query), company_ids)}
+            if "companies(" in query:
+                return {"data": self.companies(variables)}
+            if "myOrganisation" in query:
+                return {"data": self.taxonomies(variables)}
+        except (KeyError, ValueError) as err:
+            return {"errors": [{"message": "Invalid variables: " + str(err)}]}
+        return {"errors": [{"message": "Unsupported query"}]}
+
+    def respond(self, body, accept_encoding=""):
+        """Answer a request body.
+
+        Waits for the configured latency, then returns the status, a
+        dictionary of headers and the body of the response. The body is
+        compressed with gzip or deflate when accept_encoding allows it.
+        """
+        with self._lock:
+            self.requests += 1
+            wait = self.latency + self._random.uniform(0, self.jitter)
+            limited = self._random.random() < self.rate_limit
+            if limited:
+                self.rate_limited += 1
+        if wait > 0:
+            sleep(wait)
+        if limited:
+            return 429, {"Retry-After": str(self.retry_after)}, b""
+        data = json.dumps(self._answer(body)).encode("UTF-8")
+        headers = {"Content-Type": "application/json"}
+        encodings = [
+            encoding.split(";")[0].strip()
+            for encoding in accept_encoding.lower().split(",")]
+        if "gzip" in encodings:
+            data = gzip.compress(data, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        elif "deflate" in encodings:
+            data = zlib.compress(data)
+            headers["Content-Encoding"] = "deflate"
+        return 200, headers, data
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which would otherwise wait
+    # on the client's delayed acknowledgement.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        status, headers, data = self.server.api.respond(
+            body, self.headers.get("Accept-Encoding", ""))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockServer(ThreadingHTTPServer):
+    """An HTTP server answering requests with a MockAPI.
+
+    Keyword Arguments:
+        - api -- The MockAPI to answer requests with.
+        - host -- The address to listen on.
+            Default "127.0.0.1"
+        - port -- The port to listen on, 0 picks a free port.
+            Default 0
+        - verbose -- Log every request to stderr.
+            Default False
+
+    Attributes:
+        - url -- The URL to pass to Client to query the server.
+
+    Methods:
+        - start() -- Serve requests from a background thread.
+        - shutdown() -- Stop serving requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, api, host="127.0.0.1", port=0, verbose=False):
+        super().__init__((host, port), _Handler)
+        self.api = api
+        self.verbose = verbose
+        self.url = "http://{}:{}/graphql".format(*self.server_address[:2])
+
+    def start(self):
+        """Serve requests from a background thread."""
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+
+    parser = ArgumentParser(
+        prog="Mock API",
+        description="""Serve a local stand-in for the Polecat API.\n
+        Answers the documents, companies and myOrganisation queries with
+        generated data, for trying out and benchmarking the scripts without
+        an API token. Point a Client at the URL printed on start up.
+        """,
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument("--host",
+                        help=dedent("""\
+                        OPTIONAL. The address to listen on.
+                        Default 127.0.0.1
+
+                        """),
+                        type=str,
+                        default="127.0.0.1")
+    parser.add_argument("--port",
+                        help=dedent("""\
+                        OPTIONAL. The port to listen on.
+                        Default 0 (any free port)
+
+                        """),
+                        type=int,
+                        default=0)
+    parser.add_argument("--documents-per-day",
+                        help=dedent("""\
+                        OPTIONAL. The number of documents matching an
+                        insight on each day.
+                        Default 100
+
+                        """),
+                        type=int,
+                        default=100)
+    parser.add_argument("--document-size",
+                        help=dedent("""\
+                        OPTIONAL. The approximate size of each document
+                        in bytes.
+                        Default 1000
+
+                        """),
+                        type=int,
+                        default=1000)
+    parser.add_argument("--companies",
+                        help=dedent("""\
+                        OPTIONAL. The number of companies to search.
+                        Default 10000
+
+                        """),
+                        type=int,
+                        default=10000)
+    parser.add_argument("--latency",
+                        help=dedent("""\
+                        OPTIONAL. Seconds to wait before every response.
+                        Default 0
+
+                        """),
+                        type=float,
+                        default=0)
+    parser.add_argument("--jitter",
+                        help=dedent("""\
+                        OPTIONAL. Up to this many extra seconds are
+                        randomly added to the wait before every response.
+                        Default 0
+
+                        """),
+                        type=float,
+                        default=0)
+    parser.add_argument("--rate-limit",
+                        help=dedent("""\
+                        OPTIONAL. The chance, from 0 to 1, of answering a
+                        request with a 429 rate limit response.
+                        Default 0
+
+                        """),
+                        type=float,
+                        default=0)
+    parser.add_argument("--retry-after",
+                        help=dedent("""\
+                        OPTIONAL. The Retry-After seconds of 429 responses.
+                        Default 1
+
+                        """),
+                        type=int,
+                        default=1)
+    parser.add_argument("--max-page-size",
+                        help=dedent("""\
+                        OPTIONAL. The most results returned in a page.
+                        Default 1000
+
+                        """),
+                        type=int,
+                        default=1000)
+    parser.add_argument("--companies-per-document",
+                        help=dedent("""\
+                        OPTIONAL. The number of companies each document
+                        mentions, including the focus company.
+                        Default 2
+
+                        """),
+                        type=int,
+                        default=2)
+    parser.add_argument("--no-company-filter",
+                        help=dedent("""\
+                        OPTIONAL. Don't support filtering the companies of
+                        documents by id.
+
+                        """),
+                        action="store_true")
+    parser.add_argument("--seed",
+                        help=dedent("""\
+                        OPTIONAL. Seed for the random latency and 429
+                        responses, to make them repeatable.
+
+                        """),
+                        type=int)
+    parser.add_argument("--verbose",
+                        help=dedent("""\
+                        OPTIONAL. Log every request.
+
+                        """),
+                        action="store_true")
+    args = parser.parse_args()
+
+    api = MockAPI(
+        args.documents_per_day, args.document_size, args.companies,
+        args.latency, args.jitter, args.rate_limit, args.retry_after,
+        args.max_page_size, args.companies_per_document,
+        not args.no_company_filter, args.seed)
+    server = MockServer(api, args.host, args.port, args.verbose)
+    print("Serving on " + server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
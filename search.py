@@ -1,8 +1,185 @@
+import sqlite3
+from contextlib import closing
+from time import time
+
 from download_docs import Client
-from argparse import ArgumentParser
+from transport import RateLimiter
+from argparse import ArgumentParser, ArgumentTypeError
 
 
-def search_companies(client, name):
+INDEX_FILE = "companies_index.sqlite"
+
+
+def normalise_name(name):
+    """Return a name in the form it is compared in, ignoring case and spacing."""
+    return " ".join(name.casefold().split())
+
+
+class CompanyIndex:
+    """An on-disk index of the companies found by earlier searches.
+
+    Companies are kept in a SQLite database with their normalised names
+    indexed, so exact and prefix lookups take O(log n) time rather than
+    paging through the API. The results of each search are kept too, so
+    repeating a search doesn't need the API. Anything fetched longer ago
+    than the ttl is stale and ignored, and only companies found by a
+    complete search are used for exact and prefix lookups.
+
+    Keyword Arguments:
+        - path -- The path of the database file.
+            Default companies_index.sqlite
+        - ttl -- The number of seconds that fetched companies stay fresh.
+            Default 86400 (a day)
+
+    Methods:
+        - exact(name) -- Return the fresh companies with the name.
+        - prefix(name) -- Return the fresh companies with names starting
+            with name.
+        - search(name) -- Return the results of a fresh earlier search for
+            name, or None if it hasn't been searched for recently.
+        - add_search(name, companies) -- Store the results of a search.
+        - companies(client, name) -- Yield the companies found by searching
+            for name, from the index when fresh or otherwise from the API.
+        - close() -- Close the database.
+
+    Companies are (name, id) tuples, as returned by search_companies.
+    """
+
+    def __init__(self, path=INDEX_FILE, ttl=86400):
+        self.ttl = ttl
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS companies (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    normalised_name TEXT NOT NULL,
+                    fetched REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS companies_normalised_name
+                    ON companies (normalised_name);
+                CREATE TABLE IF NOT EXISTS searches (
+                    normalised_name TEXT PRIMARY KEY,
+                    fetched REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS search_results (
+                    search TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    company_id TEXT NOT NULL,
+                    PRIMARY KEY (search, position)
+                );
+                CREATE INDEX IF NOT EXISTS search_results_company
+                    ON search_results (company_id);
+            """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _oldest_fresh(self):
+        return time() - self.ttl
+
+    # Only companies in the results of a complete search that is still fresh
+    # are trusted, so a search stopped early never answers a lookup.
+    _FOUND_BY_FRESH_SEARCH = """
+        EXISTS (
+            SELECT 1 FROM search_results
+            JOIN searches ON searches.normalised_name = search_results.search
+            WHERE search_results.company_id = companies.id
+                AND searches.fetched >= ?
+        )
+    """
+
+    def exact(self, name):
+        return self._db.execute("""
+            SELECT name, id FROM companies
+            WHERE normalised_name = ? AND %s
+            ORDER BY name, id
+        """ % self._FOUND_BY_FRESH_SEARCH,
+            (normalise_name(name), self._oldest_fresh())).fetchall()
+
+    def prefix(self, name):
+        start = normalise_name(name)
+        # No normalised name starting with start sorts after start followed
+        # by the last unicode character.
+        return self._db.execute("""
+            SELECT name, id FROM companies
+            WHERE normalised_name >= ? AND normalised_name < ? AND %s
+            ORDER BY normalised_name, id
+        """ % self._FOUND_BY_FRESH_SEARCH,
+            (start, start + chr(0x10ffff), self._oldest_fresh())).fetchall()
+
+    def search(self, name):
+        search = normalise_name(name)
+        fresh = self._db.execute(
+            "SELECT 1 FROM searches WHERE normalised_name = ? AND fetched >= ?",
+            (search, self._oldest_fresh())).fetchone()
+        if fresh is None:
+            return None
+        companies = {"best": [], "all": []}
+        for company_name, company_id, normalised in self._db.execute("""
+                SELECT companies.name, companies.id, companies.normalised_name
+                FROM search_results
+                JOIN companies ON companies.id = search_results.company_id
+                WHERE search_results.search = ?
+                ORDER BY search_results.position
+                """, (search,)):
+            companies["all"].append((company_name, company_id))
+            if normalised == search:
+                companies["best"].append((company_name, company_id))
+        return companies
+
+    def _insert_companies(self, companies, fetched):
+        self._db.executemany("""
+            INSERT OR REPLACE INTO companies
+                (id, name, normalised_name, fetched)
+            VALUES (?, ?, ?, ?)
+        """, (
+            (company_id, company_name, normalise_name(company_name), fetched)
+            for company_name, company_id in companies))
+
+    def add_search(self, name, companies):
+        search = normalise_name(name)
+        fetched = time()
+        with self._db:
+            self._insert_companies(companies, fetched)
+            self._db.execute(
+                "DELETE FROM search_results WHERE search = ?", (search,))
+            self._db.executemany("""
+                INSERT INTO search_results (search, position, company_id)
+                VALUES (?, ?, ?)
+            """, (
+                (search, position, company_id)
+                for position, (_, company_id) in enumerate(companies)))
+            self._db.execute(
+                "INSERT OR REPLACE INTO searches (normalised_name, fetched)"
+                " VALUES (?, ?)", (search, fetched))
+
+    def companies(self, client, name):
+        cached = self.search(name)
+        if cached is not None:
+            yield from cached["all"]
+            return
+        # A search stopped early isn't stored, since its results are partial.
+        found = []
+        for company in iter_companies(client, name):
+            found.append(company)
+            yield company
+        self.add_search(name, found)
+
+    def close(self):
+        self._db.close()
+
+
+def iter_companies(client, name):
+    """Yield the (name, id) of each company found by searching for name.
+
+    Companies are yielded as each page arrives and the next page is only
+    requested once the previous one has been used, so stopping early saves
+    the remaining requests.
+    """
     q = """
         query Companies($first: Int!, $after: Cursor, $search: String) {
             companies(first: $first, after: $after, search: $search) {
@@ -16,23 +193,61 @@ def search_companies(client, name):
         "search": name
     }
     next_page = True
-    companies = {"best": [], "all": []}
     while next_page:
         response = client.execute_query_with_retries(q, v)
         for company in response["data"]["companies"]["edges"]:
-            companies["all"] += [(
-                company["node"]["name"],
-                company["node"]["id"]
-            )]
-            if company["node"]["name"].lower() == name.lower():
-                companies["best"] += [(
-                    company["node"]["name"], 
-                    company["node"]["id"]
-                )]
+            yield (company["node"]["name"], company["node"]["id"])
 
         v["after"] = response["data"]["companies"]["pageInfo"]["endCursor"]
         next_page = response["data"]["companies"]["pageInfo"]["hasNextPage"]
-    
+
+def take_companies(companies, name, first_exact=False, limit=None):
+    """Yield (company, exact) for companies until a stopping point.
+
+    exact is whether the company's name matches name, compared as
+    normalise_name does. Stops after the first exact match if first_exact,
+    or after limit companies.
+    """
+    if limit is not None and limit < 1:
+        return
+    name = normalise_name(name)
+    count = 0
+    for company in companies:
+        exact = normalise_name(company[0]) == name
+        yield company, exact
+        count += 1
+        if (first_exact and exact) or (limit is not None and count >= limit):
+            return
+
+def search_companies(client, name):
+    companies = {"best": [], "all": []}
+    for company, exact in take_companies(iter_companies(client, name), name):
+        companies["all"].append(company)
+        if exact:
+            companies["best"].append(company)
+    return companies
+
+def search_companies_indexed(client, index, name, mode="search"):
+    """Search for companies, answering from an index where it can.
+
+    With mode "exact" only exact matches are looked up and "prefix" looks
+    up companies with names starting with name. Otherwise the results of
+    the API search are returned. The API is only searched when the index
+    has no fresh answer, and its results are added to the index.
+    """
+    if mode == "exact":
+        best = index.exact(name)
+        if best:
+            return {"best": best, "all": best}
+    companies = index.search(name)
+    if companies is None:
+        companies = search_companies(client, name)
+        index.add_search(name, companies["all"])
+    if mode == "exact":
+        return {"best": companies["best"], "all": companies["best"]}
+    if mode == "prefix":
+        matches = index.prefix(name)
+        return {"best": index.exact(name), "all": matches}
     return companies
 
 def search_taxonomy(client, name):
@@ -63,6 +278,42 @@ def output_result(result):
     if len(result["all"]) > 0:
         output(result["all"])
 
+def stream_companies(client, name, first_exact=False, limit=None, index=None):
+    """Print the companies found by searching for name as they arrive.
+
+    Stops requesting pages after the first exact match if first_exact, or
+    after limit companies. With an index, an exact match already in the
+    index is printed without searching, otherwise the search is answered
+    from the index when it can be.
+    """
+    if first_exact and index is not None:
+        best = index.exact(name)
+        if best:
+            print("First exact match:")
+            output(best[:1])
+            return
+    if index is None:
+        companies = iter_companies(client, name)
+    else:
+        companies = index.companies(client, name)
+    print ("{:<14} {:<70}".format('ID','NAME'))
+    count = 0
+    first = None
+    with closing(companies):
+        for company, exact in take_companies(
+                companies, name, first_exact, limit):
+            print ("{:<14} {:<70}".format(company[1], company[0]), flush=True)
+            count += 1
+            if exact and first is None:
+                first = company
+    print()
+    print("Total matches: " + str(count))
+    if first_exact and first is None:
+        print("No exact match")
+    elif first_exact:
+        print("First exact match:")
+        output([first])
+
 def output(result):    
     print ("{:<14} {:<70}".format('ID','NAME'))
     for value in result:
@@ -70,6 +321,24 @@ def output(result):
     print()
 
 
+def positive_int(value):
+    """Validate a flag that must be a positive number."""
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise ArgumentTypeError("must be a positive number")
+
+
+def positive_float(value):
+    """Validate a flag that must be a positive number, not only a whole one."""
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0
+    if number > 0 and number != float("inf"):
+        return number
+    raise ArgumentTypeError("must be a positive number")
+
+
 def main():
 
     parser = ArgumentParser(
@@ -87,11 +356,65 @@ def main():
     type.add_argument("--taxonomy",
                         help="to search for taxonomy",
                         action="store_true")
+    parser.add_argument("--index",
+                        help="file to keep an index of companies searched"
+                             " for in, to answer repeated searches from",
+                        nargs="?",
+                        const=INDEX_FILE,
+                        type=str)
+    parser.add_argument("--index-ttl",
+                        help="hours before companies in the index are"
+                             " searched for again, default 24",
+                        type=float,
+                        default=24)
+    lookup = parser.add_mutually_exclusive_group()
+    lookup.add_argument("--exact",
+                        help="only find companies with exactly the name",
+                        action="store_true")
+    lookup.add_argument("--prefix",
+                        help="find indexed companies with names starting"
+                             " with the name",
+                        action="store_true")
+    parser.add_argument("--first-exact",
+                        help="stop searching for companies at the first"
+                             " exact match, printing results as they arrive",
+                        action="store_true")
+    parser.add_argument("--limit",
+                        help="stop searching for companies after this many"
+                             " results, printing results as they arrive",
+                        type=positive_int)
+    parser.add_argument("--rate",
+                        help="maximum number of requests per second",
+                        type=positive_float)
+    parser.add_argument("--rate-lock",
+                        help="file to share the rate limit with other scripts",
+                        type=str)
     args = parser.parse_args()
+    if (args.exact or args.prefix) and not (args.index and args.company):
+        parser.error("--exact and --prefix need --index and --company")
+    streaming = args.first_exact or args.limit is not None
+    if streaming and not args.company:
+        parser.error("--first-exact and --limit need --company")
+    if streaming and (args.exact or args.prefix):
+        parser.error("--first-exact and --limit cannot be used with --exact"
+                     " or --prefix")
 
-    client = Client()
+    client = Client(
+        rate_limiter=RateLimiter(args.rate, lock_file=args.rate_lock))
 
-    if args.company:
+    if streaming and args.index:
+        with CompanyIndex(args.index, args.index_ttl * 3600) as index:
+            stream_companies(
+                client, args.name, args.first_exact, args.limit, index)
+        return
+    if streaming:
+        stream_companies(client, args.name, args.first_exact, args.limit)
+        return
+    if args.company and args.index:
+        mode = "exact" if args.exact else "prefix" if args.prefix else "search"
+        with CompanyIndex(args.index, args.index_ttl * 3600) as index:
+            result = search_companies_indexed(client, index, args.name, mode)
+    elif args.company:
         result = search_companies(client, args.name)
     if args.taxonomy:
         result = search_taxonomy(client, args.name)
@@ -0,0 +1,764 @@
+import csv
+import gzip
+import re
+import sqlite3
+from datetime import datetime, timedelta
+from io import TextIOWrapper
+from os import fsync
+from pathlib import Path
+
+# Optional, only needed for the parquet and arrow output formats. Imported
+# by the first ArrowSink, as importing it takes longer than a small CSV
+# download.
+pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, only needed for zstd compressed CSVs.
+    zstandard = None
+
+
+CSV_FILES = {
+    "documents": "documents.csv",
+    "denormalised": "documents_denormalised.csv",
+    "companies": "documents_companies.csv",
+    "topics": "documents_topics.csv",
+}
+
+
+HEADERS = {
+    "documents": (
+        "id",
+        "harvest_time",
+        "sentiment",
+        "reach",
+        "publisher",
+        "domain",
+        "source",
+        "url",
+        "title",
+    ),
+    "denormalised": (
+        "document_id",
+        "harvest_time",
+        "data_source",
+        "sentiment",
+        "reach",
+        "company_id",
+        "company_name",
+        "company_significance",
+        "topic_id",
+        "topic_name",
+        "topic_significance",
+    ),
+    "companies": (
+        "document_id",
+        "company_id",
+        "company_name",
+        "company_significance",
+    ),
+    "topics": (
+        "document_id",
+        "topic_id",
+        "topic_name",
+        "topic_significance",
+    ),
+}
+
+
+# In normalised output company and topic names are written once each to
+# these dimension tables and the other tables only have their ids.
+DIMENSION_FILES = {
+    "company_names": "companies.csv",
+    "topic_names": "topics.csv",
+}
+
+
+NORMALISED_HEADERS = {
+    "documents": HEADERS["documents"],
+    "denormalised": (
+        "document_id",
+        "harvest_time",
+        "data_source",
+        "sentiment",
+        "reach",
+        "company_id",
+        "company_significance",
+        "topic_id",
+        "topic_significance",
+    ),
+    "companies": (
+        "document_id",
+        "company_id",
+        "company_significance",
+    ),
+    "topics": (
+        "document_id",
+        "topic_id",
+        "topic_significance",
+    ),
+    "company_names": (
+        "company_id",
+        "company_name",
+    ),
+    "topic_names": (
+        "topic_id",
+        "topic_name",
+    ),
+}
+
+
+# The tables whose company or topic names are kept in each dimension table.
+DIMENSION_SOURCES = {
+    "company_names": ("denormalised", "companies"),
+    "topic_names": ("denormalised", "topics"),
+}
+
+
+def output_files(normalised=False, tables=None):
+    """Return the CSV file name of each table written.
+
+    When tables is given only those keys of CSV_FILES are written, with the
+    dimension tables that they need.
+    """
+    files = CSV_FILES
+    if normalised:
+        files = dict(CSV_FILES, **DIMENSION_FILES)
+    if tables is None:
+        return files
+    return {
+        table: file for table, file in files.items()
+        if table in tables or any(
+            source in tables for source in DIMENSION_SOURCES.get(table, ()))}
+
+
+def output_headers(normalised=False, tables=None):
+    """Return the columns of each table written."""
+    headers = HEADERS
+    if normalised:
+        headers = NORMALISED_HEADERS
+    if tables is None:
+        return headers
+    return {table: headers[table] for table in output_files(normalised, tables)}
+
+
+COMPRESSED_EXTENSIONS = {
+    "gzip": ".csv.gz",
+    "zstd": ".csv.zst",
+}
+
+
+def csv_name(file, compression=None):
+    """Return the name of a CSV file compressed with gzip, zstd or None."""
+    if compression is None:
+        return file
+    return Path(file).stem + COMPRESSED_EXTENSIONS[compression]
+
+
+def compress_text(fout, compression):
+    """Return a text stream compressing what is written to a binary file.
+
+    The compressed data is written from the current position in fout as a
+    single gzip member or zstd frame, ended when the stream is closed. The
+    stream doesn't close fout. Readers treat a file of several members or
+    frames as one, so compressed CSVs can be appended to by writing new
+    members to the end.
+    """
+    if compression == "gzip":
+        return TextIOWrapper(
+            gzip.GzipFile(fileobj=fout, mode="wb", compresslevel=6))
+    if zstandard is None:
+        raise Exception("zstd compression requires zstandard, install it"
+                        + " with: pip install zstandard")
+    return TextIOWrapper(
+        zstandard.ZstdCompressor().stream_writer(fout, closefd=False))
+
+
+def open_csv(file, compression=None):
+    """Open a CSV, compressed with gzip, zstd or None, to read as text."""
+    if compression is None:
+        return open(file, newline="")
+    if compression == "gzip":
+        return gzip.open(file, "rt", newline="")
+    if zstandard is None:
+        raise Exception("zstd compression requires zstandard, install it"
+                        + " with: pip install zstandard")
+    return TextIOWrapper(
+        zstandard.ZstdDecompressor().stream_reader(
+            open(file, "rb"), read_across_frames=True),
+        newline="")
+
+
+def read_names(directory=".", compression=None):
+    """Read the ids and names already in the dimension CSVs of a directory.
+
+    Returns a dictionary of the names for each id, keyed by table.
+    """
+    names = {}
+    for table, file in DIMENSION_FILES.items():
+        names[table] = {}
+        path = Path(directory) / csv_name(file, compression)
+        if path.exists():
+            with open_csv(path, compression) as fin:
+                reader = csv.reader(fin)
+                next(reader, None)
+                names[table].update(reader)
+    return names
+
+
+def existing_csvs(
+        directory=".", extension=".csv", normalised=False, tables=None):
+    """Return the names of the output files already present in a directory.
+
+    The extension replaces .csv in the names, to check for other formats.
+    """
+    files = [
+        Path(file).stem + extension
+        for file in output_files(normalised, tables).values()]
+    return [file for file in files if (Path(directory) / file).exists()]
+
+
+def has_short_rows(file, compression=None):
+    """Return whether the first row of a CSV has fewer columns than its
+    header.
+
+    Versions of this script before data_source values were written to
+    documents_denormalised.csv left them out of every row, so appending to
+    a CSV they wrote would mix rows with different columns.
+    """
+    with open_csv(file, compression) as fin:
+        reader = csv.reader(fin)
+        header = next(reader, [])
+        row = next(reader, None)
+    return row is not None and len(row) < len(header)
+
+
+def check_appendable(existing, directory=".", compression=None):
+    """Raise an exception if an existing denormalised CSV can't be appended
+    to, see has_short_rows()."""
+    file = csv_name(CSV_FILES["denormalised"], compression)
+    if file in existing and has_short_rows(
+            Path(directory) / file, compression):
+        raise Exception(file + " was written by an older version of this"
+                        + " script without data_source values. Use"
+                        + " --overwrite or a new directory rather than"
+                        + " appending to it.")
+
+
+def write_headers(file, headers, compression=None):
+    if compression is not None:
+        with open(file, "wb") as fout, compress_text(
+                fout, compression) as text:
+            writer = csv.writer(text, dialect="unix", quoting=csv.QUOTE_ALL)
+            writer.writerow(headers)
+        return
+    with open(file, "w") as fout: 
+        writer = csv.writer(fout, dialect="unix", quoting=csv.QUOTE_ALL)
+        writer.writerow(headers)
+
+def write_all_headers(
+        existing, directory=".", extra_columns=(), normalised=False,
+        compression=None, tables=None):
+    headers = output_headers(normalised)
+    for table, file in output_files(normalised, tables).items():
+        file = csv_name(file, compression)
+        if file not in existing:
+            if table in DIMENSION_FILES:
+                write_headers(
+                    Path(directory) / file, headers[table], compression)
+            else:
+                write_headers(
+                    Path(directory) / file, extra_columns + headers[table],
+                    compression)
+
+class CSVSink:
+    """Writer for the four document CSVs that stays open for a whole run.
+
+    Opening the CSVs and creating their writers once, rather than once per
+    page, saves thousands of open, flush and close calls on large downloads.
+    Rows are held in a buffer for each file and written in batches.
+
+    The CSVs are opened in append mode, their headers should already have
+    been written with write_all_headers().
+
+    Keyword Arguments:
+        - buffer_size -- The number of rows to buffer for each CSV before
+            they are written to the file.
+            Default 1000
+        - directory -- The directory containing the CSVs.
+            Default the directory the script is called from
+        - normalised -- Also write the dimension CSVs of DIMENSION_FILES,
+            for rows from write_docs() without company and topic names.
+            Default False
+        - compression -- Write CSVs compressed with "gzip" or "zstd", named
+            by csv_name(). Rows are compressed as they are written, with a
+            new gzip member or zstd frame each time the CSVs are opened.
+            Default None
+        - tables -- The keys of CSV_FILES to write, see output_files().
+            If excluded writes all of them.
+
+    Attributes:
+        - names -- When normalised, the names already written to each
+            dimension CSV by id, starting with those already in the files.
+            Otherwise None.
+        - tables -- The tables written.
+
+    Methods:
+        - writerow(table, row) -- Add a row to the CSV for a table. The table
+            is one of the keys of output_files().
+        - writerows(table, rows) -- Add a list of rows to the CSV for a
+            table.
+        - end_page() -- Mark the end of a page of documents.
+        - flush() -- Write all buffered rows to disk.
+        - close() -- Flush and close the CSVs.
+    """
+
+    def __init__(
+            self, buffer_size=1000, directory=".", normalised=False,
+            compression=None, tables=None):
+        self.buffer_size = buffer_size
+        self.compression = compression
+        self.tables = tuple(output_files(normalised, tables))
+        self.names = None
+        if normalised:
+            self.names = read_names(directory, compression)
+        self._raw = {}
+        self._files = {}
+        self._writers = {}
+        self._buffers = {}
+        try:
+            for table, file in output_files(normalised, tables).items():
+                path = Path(directory) / csv_name(file, compression)
+                if compression is None:
+                    self._raw[table] = open(path, "a")
+                    self._files[table] = self._raw[table]
+                else:
+                    self._raw[table] = open(path, "ab")
+                self._buffers[table] = []
+                self._open_writer(table)
+        except BaseException:
+            self.close()
+            raise
+
+    def _open_writer(self, table):
+        if self.compression is not None:
+            self._files[table] = compress_text(
+                self._raw[table], self.compression)
+        self._writers[table] = csv.writer(
+            self._files[table], dialect="unix", quoting=csv.QUOTE_ALL)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def writerow(self, table, row):
+        """Add a row to the CSV for a table, writing it once the buffer fills."""
+        buffer = self._buffers[table]
+        buffer.append(row)
+        if len(buffer) >= self.buffer_size:
+            self._writers[table].writerows(buffer)
+            buffer.clear()
+
+    def writerows(self, table, rows):
+        """Add rows to the CSV for a table, writing them once the buffer
+        fills."""
+        buffer = self._buffers[table]
+        buffer.extend(rows)
+        if len(buffer) >= self.buffer_size:
+            self._writers[table].writerows(buffer)
+            buffer.clear()
+
+    def end_page(self):
+        """Mark the end of a page of documents, which needs no action."""
+
+    def flush(self):
+        """Write all buffered rows and flush the CSVs to disk."""
+        for table, buffer in self._buffers.items():
+            self._writers[table].writerows(buffer)
+            buffer.clear()
+            self._files[table].flush()
+
+    def offsets(self):
+        """Flush and sync the CSVs, returning the size of each in bytes.
+
+        Compressed CSVs start a new gzip member or zstd frame, so that they
+        can be truncated to these sizes and still be read.
+        """
+        self.flush()
+        offsets = {}
+        for table, fout in self._raw.items():
+            if self.compression is not None:
+                self._files[table].close()
+            fout.flush()
+            fsync(fout.fileno())
+            offsets[str(fout.name)] = Path(fout.name).stat().st_size
+            if self.compression is not None:
+                self._open_writer(table)
+        return offsets
+
+    def close(self):
+        """Flush and close the CSVs."""
+        try:
+            self.flush()
+        finally:
+            try:
+                if self.compression is not None:
+                    for fout in self._files.values():
+                        fout.close()
+            finally:
+                for fout in self._raw.values():
+                    fout.close()
+
+
+def parse_harvest_time(value):
+    """Parse an ISO 8601 harvestTime into a timezone aware datetime.
+
+    Times without an offset are taken to be UTC. Fractions of a second of
+    any precision are accepted.
+    """
+    match = re.match(
+        r"(\d{4}-\d\d-\d\dT\d\d:\d\d(?::\d\d)?)(?:\.(\d+))?(.*)$", value)
+    if match is None:
+        raise ValueError("Invalid harvestTime: " + value)
+    base, fraction, offset = match.groups()
+    if offset in ("", "Z", "z"):
+        offset = "+00:00"
+    parsed = datetime.fromisoformat(base + offset)
+    if fraction:
+        parsed += timedelta(microseconds=int(fraction[:6].ljust(6, "0")))
+    return parsed
+
+
+class ArrowSink:
+    """Writer for the four document tables in a columnar format.
+
+    Writes the same tables, with the same columns, as the CSVs but as
+    Parquet or Arrow IPC files which are smaller and much faster to load
+    for analysis. Columns are typed: harvest times are UTC timestamps, reach
+    is an integer, significances are floats and sentiment is a float if the
+    API returns numbers or a string otherwise. Everything else is a string.
+
+    Rows are collected in memory and written as one row group (Parquet) or
+    record batch (Arrow) for every pages_per_group pages. Existing files
+    can't be appended to, they are replaced.
+
+    Requires the pyarrow package, pip install pyarrow.
+
+    Keyword Arguments:
+        - file_format -- Either "parquet" or "arrow".
+            Default "parquet"
+        - pages_per_group -- The number of pages of documents to write in
+            each row group.
+            Default 10
+        - directory -- The directory to write the files to.
+            Default the directory the script is called from
+        - extra_columns -- Names of extra leading columns in every row,
+            except in the dimension tables.
+            Default ()
+        - normalised -- Also write the dimension tables of DIMENSION_FILES,
+            for rows from write_docs() without company and topic names.
+            Default False
+        - tables -- The keys of CSV_FILES to write, see output_files().
+            If excluded writes all of them.
+
+    Attributes:
+        - names -- When normalised, the names already written to each
+            dimension table by id. Otherwise None.
+        - tables -- The tables written.
+
+    Methods:
+        - writerow(table, row) -- Add a row to a table. The table is one of
+            the keys of output_files().
+        - writerows(table, rows) -- Add a list of rows to a table.
+        - end_page() -- Mark the end of a page of documents, writing a row
+            group every pages_per_group pages.
+        - flush() -- Write all collected rows as a row group.
+        - close() -- Flush and close the files.
+    """
+
+    extensions = {"parquet": ".parquet", "arrow": ".arrow"}
+
+    def __init__(
+            self, file_format="parquet", pages_per_group=10, directory=".",
+            extra_columns=(), normalised=False, tables=None):
+        global pyarrow
+        if pyarrow is None:
+            try:
+                import pyarrow
+                import pyarrow.ipc
+                import pyarrow.parquet
+            except ImportError:
+                raise Exception(
+                    "The " + file_format + " format requires pyarrow,"
+                    + " install it with: pip install pyarrow")
+        self.file_format = file_format
+        self.pages_per_group = pages_per_group
+        self.directory = Path(directory)
+        self.names = None
+        if normalised:
+            self.names = {table: {} for table in DIMENSION_FILES}
+        self._files = output_files(normalised, tables)
+        self.tables = tuple(self._files)
+        self._columns = {
+            table: header if table in DIMENSION_FILES
+            else tuple(extra_columns) + header
+            for table, header in output_headers(normalised, tables).items()}
+        self._rows = {table: [] for table in self._columns}
+        self._writers = {}
+        self._pages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _column_type(self, name, values):
+        """Return the Arrow type of a column and a function to convert to it."""
+        if name == "harvest_time":
+            return pyarrow.timestamp("us", tz="UTC"), parse_harvest_time
+        if name == "reach":
+            return pyarrow.int64(), int
+        if name.endswith("_significance"):
+            return pyarrow.float64(), float
+        if name == "sentiment":
+            value = next((v for v in values if v is not None), None)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return pyarrow.float64(), float
+        return pyarrow.string(), str
+
+    def _open(self, table, types):
+        schema = pyarrow.schema([
+            (name, column_type) for name, (column_type, _) in zip(
+                self._columns[table], types)])
+        file = self.directory / (
+            Path(self._files[table]).stem + self.extensions[self.file_format])
+        if self.file_format == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(str(file), schema)
+        else:
+            writer = pyarrow.ipc.new_file(str(file), schema)
+        self._writers[table] = (writer, schema, types)
+
+    def _write_group(self, table):
+        rows = self._rows[table]
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        if table not in self._writers:
+            self._open(table, [
+                self._column_type(name, values)
+                for name, values in zip(self._columns[table], columns)])
+        writer, schema, types = self._writers[table]
+        arrays = [
+            pyarrow.array(
+                [None if v is None else convert(v) for v in values],
+                type=column_type)
+            for values, (column_type, convert) in zip(columns, types)]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+        if self.file_format == "parquet":
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        rows.clear()
+
+    def writerow(self, table, row):
+        """Add a row to a table."""
+        self._rows[table].append(tuple(row))
+
+    def writerows(self, table, rows):
+        """Add rows to a table."""
+        self._rows[table].extend(map(tuple, rows))
+
+    def end_page(self):
+        """Mark the end of a page, writing a row group when enough are done."""
+        self._pages += 1
+        if self._pages % self.pages_per_group == 0:
+            self.flush()
+
+    def flush(self):
+        """Write the rows collected so far as a row group."""
+        for table in self._rows:
+            self._write_group(table)
+
+    def close(self):
+        """Flush and close the files."""
+        try:
+            self.flush()
+            for table, columns in self._columns.items():
+                if table not in self._writers:
+                    self._open(table, [
+                        self._column_type(name, ()) for name in columns])
+        finally:
+            for writer, _, _ in self._writers.values():
+                writer.close()
+
+
+# The database of the sqlite format, named after documents.csv so that the
+# same check for existing files covers it.
+SQLITE_FILE = Path(CSV_FILES["documents"]).stem + ".sqlite"
+
+
+# The columns identifying each row, which are upserted on.
+PRIMARY_KEYS = {
+    "documents": ("id",),
+    "denormalised": ("document_id", "company_id", "topic_id"),
+    "companies": ("document_id", "company_id"),
+    "topics": ("document_id", "topic_id"),
+    "company_names": ("company_id",),
+    "topic_names": ("topic_id",),
+}
+
+
+class SQLiteSink:
+    """Writer for the document tables in a SQLite database.
+
+    Each table is written to a table in documents.sqlite named after its
+    CSV, with the same columns, so the documents can be queried without
+    parsing the CSVs again. Rows are upserted on their primary key, so
+    writing the same documents again, such as when appending to an earlier
+    download over the same dates, doesn't duplicate them. Document ids,
+    harvest times, company ids and topic ids are indexed.
+
+    The rows of each page are written in a single transaction. The
+    database is in WAL mode so it can be read while it is being written.
+
+    Keyword Arguments:
+        - directory -- The directory to write documents.sqlite to.
+            Default the directory the script is called from
+        - extra_columns -- Names of extra leading columns in every row,
+            except in the dimension tables. They are part of the primary
+            key.
+            Default ()
+        - normalised -- Also write the dimension tables of DIMENSION_FILES,
+            for rows from write_docs() without company and topic names.
+            Default False
+        - replace -- Drop any tables already in the database rather than
+            adding to them.
+            Default False
+        - tables -- The keys of CSV_FILES to write, see output_files().
+            If excluded writes all of them.
+
+    Attributes:
+        - names -- When normalised, the names already written to each
+            dimension table by id, starting with those already in the
+            database. Otherwise None.
+        - tables -- The tables written.
+
+    Methods:
+        - writerow(table, row) -- Add a row to a table. The table is one of
+            the keys of output_files().
+        - writerows(table, rows) -- Add a list of rows to a table.
+        - end_page() -- Write the rows of the page in a transaction.
+        - flush() -- Write all rows added so far.
+        - offsets() -- Flush, returning no offsets as the database never
+            needs rolling back for --resume.
+        - close() -- Flush and close the database.
+    """
+
+    def __init__(
+            self, directory=".", extra_columns=(), normalised=False,
+            replace=False, tables=None):
+        files = output_files(normalised, tables)
+        self.tables = tuple(files)
+        self._tables = {
+            table: Path(file).stem for table, file in files.items()}
+        self._columns = {
+            table: header if table in DIMENSION_FILES
+            else tuple(extra_columns) + header
+            for table, header in output_headers(normalised, tables).items()}
+        self._rows = {table: [] for table in self._columns}
+        self._statements = {}
+        self._db = sqlite3.connect(
+            str(Path(directory) / SQLITE_FILE), check_same_thread=False)
+        try:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            with self._db:
+                for table, columns in self._columns.items():
+                    self._create(table, columns, extra_columns, replace)
+            self.names = None
+            if normalised:
+                self.names = {
+                    table: dict(self._db.execute(
+                        "SELECT * FROM " + self._tables[table]))
+                    if table in self._tables else {}
+                    for table in DIMENSION_FILES}
+        except BaseException:
+            self._db.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _column_type(self, name):
+        if name == "reach":
+            return "INTEGER"
+        if name.endswith("_significance"):
+            return "REAL"
+        if name == "sentiment":
+            # The API may return a label or a score.
+            return ""
+        return "TEXT"
+
+    def _create(self, table, columns, extra_columns, replace):
+        name = self._tables[table]
+        key = PRIMARY_KEYS[table]
+        if table not in DIMENSION_FILES:
+            key = tuple(extra_columns) + key
+        if replace:
+            self._db.execute("DROP TABLE IF EXISTS " + name)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))".format(
+                name,
+                ", ".join(
+                    (column + " " + self._column_type(column)).strip()
+                    for column in columns),
+                ", ".join(key)))
+        for column in (
+                "id", "document_id", "harvest_time", "company_id",
+                "topic_id"):
+            if column in columns and column != key[0]:
+                self._db.execute(
+                    "CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})".format(
+                        name, column))
+        self._statements[table] = (
+            "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+                name, ", ".join(columns), ", ".join("?" * len(columns))))
+
+    def writerow(self, table, row):
+        """Add a row to a table."""
+        self._rows[table].append(tuple(row))
+
+    def writerows(self, table, rows):
+        """Add rows to a table."""
+        self._rows[table].extend(map(tuple, rows))
+
+    def end_page(self):
+        """Write the rows of the page in a transaction."""
+        self.flush()
+
+    def flush(self):
+        """Write all rows added so far in a transaction."""
+        with self._db:
+            for table, rows in self._rows.items():
+                if rows:
+                    self._db.executemany(self._statements[table], rows)
+                    rows.clear()
+
+    def offsets(self):
+        """Flush the rows added so far, returning no offsets."""
+        self.flush()
+        return {}
+
+    def close(self):
+        """Flush and close the database."""
+        try:
+            self.flush()
+        finally:
+            self._db.close()